@@ -0,0 +1,455 @@
+#!/usr/bin/env python
+""" Benchmarks of oscar.py on a synthetic World of Code fixture
+
+The fixture mimics the layout of WoC data directories: sharded TokyoCabinet
+random access stores of commits and trees, blob offsets and .bin files,
+sequential .idx/.bin commit and tree storage and relation basemaps,
+with Perl Compress::LZF headers. So, it can be used on any Linux host:
+
+    python benchmark.py build /tmp/woc --commits 2000
+    python benchmark.py run /tmp/woc --output results.json
+
+Results are JSON, so they can be compared between releases.
+"""
+
+from __future__ import print_function
+
+import argparse
+import binascii
+import hashlib
+import json
+import os
+import platform
+import random
+import sys
+import time
+import timeit
+
+import fnvhash
+import lzf
+from tokyocabinet import hash as tch
+
+# version letter of basemaps, e.g. c2pFullB.0.tch
+FIXTURE_VERSION = 'B'
+# relation name -> (file prefix, whether keys are SHAs)
+RELATIONS = {
+    'commit_projects': ('c2p', True),
+    'commit_children': ('c2cc', True),
+    'commit_time_author': ('c2ta', True),
+    'commit_parent': ('c2pc', True),
+    'commit_files': ('c2f', True),
+    'commit_blobs': ('c2b', True),
+    'author_commits': ('a2c', False),
+    'author_projects': ('a2p', False),
+    'project_commits': ('p2c', False),
+    'project_authors': ('p2a', False),
+    'blob_commits': ('b2c', True),
+    'file_commits': ('f2c', False),
+}
+
+
+def compress(data):
+    # type: (str) -> str
+    """ Compress data the same way as Perl Compress::LZF does, i.e. with
+    UTF-8 like encoded uncompressed length header, see oscar.decomp """
+    size = len(data)
+    compressed = lzf.compress(data) if size > 3 else None
+    if compressed is None:  # incompressible or too short
+        return '\x00' + data
+    if size < 0x80:
+        header = [size]
+    elif size < 0x800:
+        header = [0xc0 | size >> 6, 0x80 | size & 0x3f]
+    elif size < 0x10000:
+        header = [0xe0 | size >> 12, 0x80 | size >> 6 & 0x3f,
+                  0x80 | size & 0x3f]
+    else:
+        header = [0xf0 | size >> 18, 0x80 | size >> 12 & 0x3f,
+                  0x80 | size >> 6 & 0x3f, 0x80 | size & 0x3f]
+    return ''.join(chr(c) for c in header) + compressed
+
+
+def ber(*numbers):
+    # type: (*int) -> str
+    """ BER-encode numbers, i.e. the inverse of oscar.unber """
+    result = []
+    for number in numbers:
+        chunk = [number & 0x7f]
+        number >>= 7
+        while number:
+            chunk.append(0x80 | number & 0x7f)
+            number >>= 7
+        result.extend(reversed(chunk))
+    return ''.join(chr(c) for c in result)
+
+
+def object_sha(obj_type, data):
+    # type: (str, str) -> str
+    return hashlib.sha1('%s %d\x00%s' % (obj_type, len(data), data)).digest()
+
+
+class ShardedStore(object):
+    """ Accumulate key-value pairs and write them into sharded .tch files
+
+    Args:
+        path_template (str): path with {key} placeholder for the shard number
+        bits (int): number of bits in shard number
+        fnv (bool): shard by FNV hash of the key (names) rather than
+            by the first byte (binary SHAs)
+    """
+    def __init__(self, path_template, bits, fnv=False):
+        self.path_template = path_template
+        self.bits = bits
+        self.fnv = fnv
+        self.shards = [{} for _ in range(2 ** bits)]
+
+    def __setitem__(self, key, value):
+        prefix = fnvhash.fnv1a_32(key) if self.fnv else ord(key[0])
+        self.shards[prefix & (2 ** self.bits - 1)][key] = value
+
+    def close(self):
+        for shard, data in enumerate(self.shards):
+            db = tch.Hash()
+            db.open(self.path_template.format(key=shard),
+                    tch.HDBOWRITER | tch.HDBOCREAT | tch.HDBOTRUNC)
+            for key in sorted(data):
+                db.put(key, data[key])
+            db.close()
+
+
+class FixtureBuilder(object):
+    """ Generate a synthetic WoC-like dataset
+
+    Projects have a mostly linear history with occasional merges. Every
+    commit modifies a few files in a nested directory structure, so there
+    are shared subtrees between commits, like in real repositories.
+
+    Args:
+        root (str): output directory, same as OSCAR_DATA_ROOT
+        projects (int): number of projects
+        commits (int): total number of commits
+        files (int): number of files in every project
+        authors (int): number of distinct authors
+        object_bits (int): shard bits of commit/tree/blob storage
+        basemap_bits (int): shard bits of relations
+        seed (int): random seed, to make fixtures reproducible
+    """
+    def __init__(self, root, projects=10, commits=1000, files=200,
+                 authors=50, object_bits=7, basemap_bits=5, seed=0):
+        self.root = root
+        self.projects = projects
+        self.commits = commits
+        self.files = files
+        self.authors = ['Author %d <author%d@example.com>' % (i, i)
+                        for i in range(authors)]
+        self.object_bits = object_bits
+        self.basemap_bits = basemap_bits
+        self.random = random.Random(seed)
+
+    def _path(self, category, filename):
+        return os.path.join(self.root, category, filename)
+
+    def build(self):
+        for category in ('All.blobs', 'All.sha1c', 'All.sha1o', 'basemaps'):
+            path = os.path.join(self.root, category)
+            if not os.path.isdir(path):
+                os.makedirs(path)
+
+        bits = self.object_bits
+        self.stores = {
+            'commit_random': ShardedStore(
+                self._path('All.sha1c', 'commit_{key}.tch'), bits),
+            'tree_random': ShardedStore(
+                self._path('All.sha1c', 'tree_{key}.tch'), bits),
+            'blob_offset': ShardedStore(
+                self._path('All.sha1o', 'sha1.blob_{key}.tch'), bits),
+        }
+        for dtype, (prefix, sha_keys) in RELATIONS.items():
+            self.stores[dtype] = ShardedStore(self._path(
+                'basemaps', '%sFull%s.{key}.tch' % (prefix, FIXTURE_VERSION)),
+                self.basemap_bits, fnv=not sha_keys)
+        self.relations = {dtype: {} for dtype in RELATIONS}
+        self.blob_files = [open(self._path('All.blobs', 'blob_%d.bin' % i),
+                                'wb') for i in range(2 ** bits)]
+        self.sequential = {
+            (obj_type, ext): [open(self._path(
+                'All.blobs', '%s_%d.%s' % (obj_type, i, ext)), 'wb')
+                for i in range(2 ** bits)]
+            for obj_type in ('commit', 'tree') for ext in ('idx', 'bin')}
+        self.seen = set()
+
+        per_project = max(1, self.commits // self.projects)
+        for i in range(self.projects):
+            self._project('project%d_repo%d' % (i % 7, i), per_project)
+
+        for dtype, relation in self.relations.items():
+            store = self.stores[dtype]
+            for key, values in relation.items():
+                if dtype in ('commit_projects', 'commit_files',
+                             'author_projects', 'project_authors'):
+                    store[key] = compress(';'.join(sorted(set(values))))
+                elif dtype == 'commit_time_author':
+                    store[key] = compress(values)
+                else:
+                    store[key] = ''.join(sorted(set(values)))
+        for store in self.stores.values():
+            store.close()
+        for fh in self.blob_files:
+            fh.close()
+        for files in self.sequential.values():
+            for fh in files:
+                fh.close()
+
+    def _relate(self, dtype, key, value):
+        self.relations[dtype].setdefault(key, []).append(value)
+
+    def _store_object(self, obj_type, data):
+        # type: (str, str) -> str
+        sha = object_sha(obj_type, data)
+        if sha in self.seen:
+            return sha
+        self.seen.add(sha)
+        shard = ord(sha[0]) & (2 ** self.object_bits - 1)
+        compressed = compress(data)
+        if obj_type == 'blob':
+            fh = self.blob_files[shard]
+            self.stores['blob_offset'][sha] = ber(fh.tell(), len(compressed))
+            fh.write(compressed)
+            return sha
+        self.stores[obj_type + '_random'][sha] = compressed
+        bin_fh = self.sequential[(obj_type, 'bin')][shard]
+        idx_fh = self.sequential[(obj_type, 'idx')][shard]
+        idx_fh.write('%d;%d;%d;%s\n' % (idx_fh.tell(), bin_fh.tell(),
+                                        len(compressed),
+                                        binascii.hexlify(sha)))
+        bin_fh.write(compressed)
+        return sha
+
+    def _blob(self, path, version):
+        lines = ['%s: line %d, revision %d, %x' % (
+            path, i, version, self.random.getrandbits(32))
+            for i in range(self.random.randint(5, 200))]
+        return self._store_object('blob', '\n'.join(lines) + '\n')
+
+    def _tree(self, files):
+        # type: (dict) -> str
+        """ Write trees for {path: blob_sha} and return the root tree SHA """
+        root = {}
+        for path, sha in files.items():
+            node = root
+            chunks = path.split('/')
+            for chunk in chunks[:-1]:
+                node = node.setdefault(chunk, {})
+            node[chunks[-1]] = sha
+
+        def write(node):
+            entries = []
+            for name, value in node.items():
+                if isinstance(value, dict):
+                    entries.append(('40000', name, write(value)))
+                else:
+                    entries.append(('100644', name, value))
+            # git sorts directories as if they had a trailing slash
+            entries.sort(key=lambda e: e[1] + ('/' if e[0] == '40000' else ''))
+            return self._store_object('tree', ''.join(
+                '%s %s\x00%s' % entry for entry in entries))
+        return write(root)
+
+    def _commit(self, tree, parents, author, timestamp, message):
+        data = 'tree %s\n' % binascii.hexlify(tree)
+        data += ''.join('parent %s\n' % binascii.hexlify(parent)
+                        for parent in parents)
+        data += 'author %s %d +0000\ncommitter %s %d +0000\n\n%s\n' % (
+            author, timestamp, author, timestamp, message)
+        return self._store_object('commit', data)
+
+    def _project(self, uri, commits):
+        depth = self.random.randint(1, 4)
+        files = {}
+        for i in range(self.files):
+            dirs = '/'.join('dir%d' % self.random.randint(0, 5)
+                            for _ in range(self.random.randint(0, depth)))
+            path = (dirs + '/' if dirs else '') + 'file%d.py' % i
+            files[path] = self._blob(path, 0)
+        paths = sorted(files)
+
+        timestamp = 1400000000 + self.random.randint(0, 10 ** 7)
+        heads = []  # (sha, files) of open branches
+        head, head_files = None, files
+        for n in range(commits):
+            author = self.random.choice(self.authors)
+            timestamp += self.random.randint(60, 86400)
+            parents = [head] if head else []
+            files = dict(head_files)
+            if heads and self.random.random() < 0.1:  # merge a branch
+                branch, branch_files = heads.pop()
+                parents.append(branch)
+                files.update(branch_files)
+            changed = self.random.sample(paths, min(len(paths), 3))
+            for path in changed:
+                files[path] = self._blob(path, n + 1)
+            sha = self._commit(self._tree(files), parents, author,
+                               timestamp, '%s: commit %d' % (uri, n))
+            if self.random.random() < 0.05:  # fork a branch
+                heads.append((sha, files))
+
+            self._relate('project_commits', uri, sha)
+            self._relate('commit_projects', sha, uri)
+            self._relate('author_commits', author, sha)
+            self._relate('author_projects', author, uri)
+            self._relate('project_authors', uri, author)
+            self.relations['commit_time_author'][sha] = \
+                '%d;%s' % (timestamp, author)
+            for parent in parents:
+                self._relate('commit_parent', sha, parent)
+                self._relate('commit_children', parent, sha)
+            for path in changed:
+                self._relate('commit_files', sha, path)
+                self._relate('commit_blobs', sha, files[path])
+                self._relate('blob_commits', files[path], sha)
+                self._relate('file_commits', path, sha)
+            head, head_files = sha, files
+
+
+def _load_oscar(root):
+    """ Import oscar configured to use the fixture """
+    os.environ['OSCAR_DATA_ROOT'] = root
+    os.environ.setdefault('OSCAR_BASEMAPS_VER', FIXTURE_VERSION)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import oscar
+    return oscar
+
+
+def _reset_caches(oscar):
+    """ Drop object caches, so every repetition starts cold.
+    TokyoCabinet handles stay open, as they would in a long running job """
+    oscar._OBJECT_CACHE.clear()
+    oscar._SUBTREE_FILES.clear()
+    oscar._SUBTREE_COUNTS.clear()
+
+
+def benchmarks(oscar, sample_size, seed=0):
+    """ Benchmark name -> (function, number of operations per call) """
+    rnd = random.Random(seed)
+    all_commits = [c.bin_sha for c in oscar.Commit.all(lazy=True)]
+    commits = rnd.sample(all_commits, min(sample_size, len(all_commits)))
+    commit_objs = [oscar.Commit(sha) for sha in commits]
+    trees = [c.tree.bin_sha for c in commit_objs]
+    blobs = sorted(set(sha for c in commit_objs
+                       for sha in oscar.Commit(c.bin_sha).blob_shas))
+    blobs = rnd.sample(blobs, min(sample_size, len(blobs)))
+    pairs = [(c.bin_sha, c.parent_shas[0]) for c in commit_objs
+             if c.parent_shas]
+    projects = sorted(set(name for c in commit_objs
+                          for name in c.project_names))
+
+    def read_tch():
+        for sha in commits:
+            oscar.read_tch(oscar.resolve_path('commit_projects', sha), sha)
+
+    def blob_data():
+        for sha in blobs:
+            oscar.Blob(sha).data
+
+    def tree_traverse():
+        for sha in trees:
+            for _ in oscar.Tree(sha).traverse():
+                pass
+
+    def commit_diff():
+        for sha, parent in pairs:
+            tuple(oscar.Commit(sha) - oscar.Commit(parent))
+
+    def project_head():
+        for uri in projects:
+            oscar.Project(uri).head
+
+    def commit_all():
+        for _ in oscar.Commit.all():
+            pass
+
+    def commit_all_lazy():
+        for _ in oscar.Commit.all(lazy=True):
+            pass
+
+    return {
+        'read_tch': (read_tch, len(commits)),
+        'Blob.data': (blob_data, len(blobs)),
+        'Tree.traverse': (tree_traverse, len(trees)),
+        'Commit.__sub__': (commit_diff, len(pairs)),
+        'Project.head': (project_head, len(projects)),
+        'GitObject.all': (commit_all, len(all_commits)),
+        'GitObject.all(lazy)': (commit_all_lazy, len(all_commits)),
+    }
+
+
+def run(root, repeat=5, sample_size=200, names=None):
+    """ Run benchmarks and return results as a JSON-serializable dict """
+    oscar = _load_oscar(root)
+    results = []
+    for name, (func, ops) in sorted(benchmarks(oscar, sample_size).items()):
+        if names and name not in names:
+            continue
+        timer = timeit.Timer(func, setup=lambda: _reset_caches(oscar))
+        timings = sorted(timer.repeat(repeat=repeat, number=1))
+        results.append({
+            'name': name,
+            'operations': ops,
+            'repeat': repeat,
+            'min': timings[0],
+            'median': timings[len(timings) // 2],
+            'max': timings[-1],
+            'ops_per_sec': ops / timings[0] if timings[0] else None,
+        })
+    return {
+        'oscar_version': oscar.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': int(time.time()),
+        'data_root': root,
+        'results': results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    subparsers = parser.add_subparsers(dest='command')
+
+    build_parser = subparsers.add_parser('build', help='build a fixture')
+    build_parser.add_argument('root', help='output directory')
+    build_parser.add_argument('--projects', type=int, default=10)
+    build_parser.add_argument('--commits', type=int, default=1000)
+    build_parser.add_argument('--files', type=int, default=200)
+    build_parser.add_argument('--authors', type=int, default=50)
+    build_parser.add_argument('--object-bits', type=int, default=7)
+    build_parser.add_argument('--basemap-bits', type=int, default=5)
+    build_parser.add_argument('--seed', type=int, default=0)
+
+    run_parser = subparsers.add_parser('run', help='run benchmarks')
+    run_parser.add_argument('root', help='fixture directory')
+    run_parser.add_argument('--repeat', type=int, default=5)
+    run_parser.add_argument('--sample-size', type=int, default=200)
+    run_parser.add_argument('--only', action='append',
+                            help='benchmark name, can be used multiple times')
+    run_parser.add_argument('--output', help='output file, stdout by default')
+
+    args = parser.parse_args()
+    if args.command == 'build':
+        FixtureBuilder(
+            args.root, projects=args.projects, commits=args.commits,
+            files=args.files, authors=args.authors,
+            object_bits=args.object_bits, basemap_bits=args.basemap_bits,
+            seed=args.seed).build()
+        return
+
+    result = json.dumps(run(args.root, args.repeat, args.sample_size,
+                            args.only), indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as fh:
+            fh.write(result)
+    else:
+        print(result)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,20 +1,33 @@
 import lzf
-import pygit2
 
+import atexit
+import binascii
+import bisect
+from collections import Counter, Mapping, OrderedDict
+from contextlib import contextmanager
 from datetime import datetime, timedelta, tzinfo
-import difflib
 import fnvhash  # TODO: implement Cython version
 from functools import wraps
 import glob
 import hashlib
+import heapq
+import itertools
+import json
 from math import log
+import mmap
+import multiprocessing
 import os
 import re
+import struct
+import threading
 import time
+import traceback
 import warnings
+import zlib
 
-import clickhouse_driver as clickhouse
+import numpy as np
 import six
+from six.moves import queue as Queue
 from tokyocabinet import hash as tch
 
 
@@ -23,21 +36,30 @@ __version__ = '1.3.3'
 __author__ = "Marat (@cmu.edu)"
 __license__ = "GPL v3"
 
-try:
-    with open('/etc/hostname') as fh:
-        HOSTNAME = fh.read().strip()
-except IOError:
-    raise ImportError('Oscar only support Linux hosts so far')
+# Root of a local copy of the data, e.g. a synthetic fixture built by
+# benchmark.py. If set, data directories are looked up under this root
+# (e.g. $OSCAR_DATA_ROOT/basemaps) and the host is not checked.
+DATA_ROOT = os.environ.get('OSCAR_DATA_ROOT')
+COMMIT_HOSTS = ('da4', 'da5')
+
+if DATA_ROOT:
+    HOSTNAME = HOST = DOMAIN = None
+else:
+    try:
+        with open('/etc/hostname') as fh:
+            HOSTNAME = fh.read().strip()
+    except IOError:
+        raise ImportError('Oscar only support Linux hosts so far')
 
-if not re.match('da\d.eecs.utk.edu$', HOSTNAME):
-    raise ImportError('Oscar is only available on certain servers at UTK, '
-                      'please modify to match your cluster configuration')
+    if not re.match('da\d.eecs.utk.edu$', HOSTNAME):
+        raise ImportError('Oscar is only available on certain servers at '
+                          'UTK, please modify to match your cluster '
+                          'configuration or set OSCAR_DATA_ROOT')
 
-HOST, DOMAIN = HOSTNAME.split('.', 1)
-COMMIT_HOSTS = ('da4', 'da5')
-if HOST not in COMMIT_HOSTS:
-    warnings.warn('Commit and tree direct content is only available on da4. '
-                  'Some functions might not work as expected.\n\n')
+    HOST, DOMAIN = HOSTNAME.split('.', 1)
+    if HOST not in COMMIT_HOSTS:
+        warnings.warn('Commit and tree direct content is only available on '
+                      'da4. Some functions might not work as expected.\n\n')
 
 
 def _latest_version(path_template):
@@ -69,42 +91,177 @@ def _key_length(path_template):
 VERSIONS = {}
 
 
-def _get_paths(raw_paths):
-    # type: (dict) -> dict
+class _PathsManifest(object):
+    """ On-disk cache of resolved paths, to avoid globbing data directories
+
+    Every entry maps a data type to its path template, version and key length,
+    along with the mtime of the data directory at the moment of resolution.
+    An entry is only considered valid if the directory was not modified since.
+    The manifest is a JSON file, its location is set by OSCAR_PATHS_MANIFEST.
     """
-    Compose path from
-    Args:
-        raw_paths (Dict[Tuple[str, Dict[str, str]]]): see example below
+    # number of updates to accumulate before writing the manifest
+    flush_size = 16
 
-    Returns:
-        (Dict[str, Tuple[str, int]]: map data type to a path template and a key
-            length, e.g.:
-            'author_commits' -> ('/da0_data/basemaps/a2cFullR.{key}.tch', 5)
+    def __init__(self, path):
+        self.path = path
+        self._entries = None
+        self._pending = {}  # updates not written to disk yet
+        self._lock = threading.Lock()
+        if path:
+            atexit.register(self.flush)
+
+    def _load(self):
+        # type: () -> dict
+        try:
+            with open(self.path) as fh:
+                return json.load(fh)
+        except (IOError, OSError, ValueError):
+            return {}  # no manifest yet, or it is corrupted
+
+    @property
+    def entries(self):
+        if self._entries is None:
+            self._entries = self._load() if self.path else {}
+        return self._entries
+
+    @staticmethod
+    def _mtime(path_template):
+        try:
+            return os.stat(os.path.dirname(path_template)).st_mtime
+        except OSError:
+            return None
+
+    def get(self, ptype, path_template, version=None):
+        # type: (str, str, Optional[str]) -> Optional[Tuple[str, int]]
+        """ Get a (version, key_length) tuple or None if there is no valid
+        entry for the given template (and version, if specified) """
+        entry = self.entries.get(ptype)
+        if not entry or entry['template'] != path_template \
+                or entry['mtime'] != self._mtime(path_template) \
+                or (version is not None and entry['version'] != version):
+            return None
+        return str(entry['version']), entry['key_length']
+
+    def set(self, ptype, path_template, version, key_length):
+        """ Update an entry. Updates are written to disk in batches,
+        when `flush_size` of them are accumulated or at exit """
+        if not self.path:
+            return
+        entry = {
+            'template': path_template,
+            'version': version,
+            'key_length': key_length,
+            'mtime': self._mtime(path_template),
+        }
+        with self._lock:
+            self.entries[ptype] = entry
+            self._pending[ptype] = entry
+            if len(self._pending) < self.flush_size:
+                return
+        self.flush()
+
+    def flush(self):
+        """ Write pending updates, merged with the manifest on disk
+        so updates by concurrent processes are not lost """
+        with self._lock:
+            if not self._pending:
+                return
+            entries = self._load()
+            entries.update(self._pending)
+            # write to a temp file first, so readers never see partial data
+            tmp_path = '%s.%d.%d.tmp' % (
+                self.path, os.getpid(), threading.current_thread().ident)
+            try:
+                with open(tmp_path, 'w') as fh:
+                    json.dump(entries, fh, indent=2, sort_keys=True)
+                os.rename(tmp_path, self.path)
+            except (IOError, OSError):
+                warnings.warn("Failed to update paths manifest " + self.path)
+                return
+            self._pending = {}
+            self._entries = entries
+
+
+class _Paths(Mapping):
+    """ Lazy mapping of data types to (path template, key length), e.g.:
+        'author_commits' -> ('/da0_data/basemaps/a2cFullR.{key}.tch', 5)
+
+    Resolving versions and key lengths requires globbing data directories,
+    which is slow on network filesystems. So, paths are resolved on the first
+    access to every data type, rather than at import time.
+
+    Args:
+        raw_paths (Dict[str, Tuple[str, Dict[str, str]]]): category (env
+            variable to override path prefix) -> (path prefix, filenames),
+            where filenames maps data types to file name templates
     """
-    paths = {}
-    local_data_prefix = '/' + HOST + '_data'
-    for category, (path_prefix, filenames) in raw_paths.items():
-        cat_path_prefix = os.environ.get(category, path_prefix)
-        cat_version = os.environ.get(category + '_VER') or _latest_version(
-            os.path.join(cat_path_prefix, filenames.values()[0]))
-
-        if path_prefix.startswith(local_data_prefix):
-            path_prefix = '/data' + path_prefix[len(local_data_prefix):]
-
-        for ptype, fname in filenames.items():
-            ppath = os.environ.get(
-                '_'.join(['OSCAR', ptype.upper()]), cat_path_prefix)
-            pver = os.environ.get(
-                '_'.join(['OSCAR', ptype.upper(), 'VER']), cat_version)
-            path_template = os.path.join(ppath, fname)
+    def __init__(self, raw_paths):
+        self.raw_paths = raw_paths
+        self.manifest = _PathsManifest(os.environ.get('OSCAR_PATHS_MANIFEST'))
+        self._categories = {
+            ptype: category
+            for category, (_, filenames) in raw_paths.items()
+            for ptype in filenames}
+        self._versions = {}  # category -> latest version
+        self._paths = {}
+        self._lock = threading.Lock()
+
+    def _category_prefix(self, category):
+        # type: (str) -> str
+        """ Path prefix of a category, overridden by an env variable with
+        the category name or rebased to OSCAR_DATA_ROOT """
+        path_prefix, filenames = self.raw_paths[category]
+        if DATA_ROOT:
+            path_prefix = os.path.join(
+                DATA_ROOT, os.path.basename(path_prefix.rstrip('/')))
+        return os.environ.get(category, path_prefix)
+
+    def _category_version(self, category):
+        if category not in self._versions:
+            path_prefix, filenames = self.raw_paths[category]
+            cat_path_prefix = self._category_prefix(category)
+            self._versions[category] = \
+                os.environ.get(category + '_VER') or _latest_version(
+                    os.path.join(cat_path_prefix, filenames.values()[0]))
+        return self._versions[category]
+
+    def _resolve(self, ptype):
+        # type: (str) -> Tuple[str, int]
+        category = self._categories[ptype]
+        path_prefix, filenames = self.raw_paths[category]
+        ppath = os.environ.get('_'.join(['OSCAR', ptype.upper()]),
+                               self._category_prefix(category))
+        path_template = os.path.join(ppath, filenames[ptype])
+        pver = os.environ.get('_'.join(['OSCAR', ptype.upper(), 'VER']),
+                              os.environ.get(category + '_VER'))
+
+        cached = self.manifest.get(ptype, path_template, pver)
+        if cached:
+            pver, key_length = cached
+        else:
+            if pver is None:
+                pver = self._category_version(category)
             key_length = _key_length(path_template)
-            VERSIONS[ptype] = pver
-            paths[ptype] = (
-                path_template.format(ver=pver, key='{key}'), key_length)
-    return paths
+            self.manifest.set(ptype, path_template, pver, key_length)
+
+        VERSIONS[ptype] = pver
+        return path_template.format(ver=pver, key='{key}'), key_length
+
+    def __getitem__(self, ptype):
+        if ptype not in self._paths:
+            with self._lock:
+                if ptype not in self._paths:
+                    self._paths[ptype] = self._resolve(ptype)
+        return self._paths[ptype]
 
+    def __iter__(self):
+        return iter(self._categories)
+
+    def __len__(self):
+        return len(self._categories)
 
-PATHS = _get_paths({
+
+PATHS = _Paths({
     'OSCAR_ALL_BLOBS': ('/da4_data/All.blobs/', {
         'commit_sequential_idx': 'commit_{key}.idx',
         'commit_sequential_bin': 'commit_{key}.bin',
@@ -191,6 +348,10 @@ URL_PREFIXES = {
 }
 
 
+# number of keys to read at once in bulk operations, see read_tch_many
+BATCH_SIZE = 1000
+
+
 class ObjectNotFound(KeyError):
     pass
 
@@ -217,6 +378,8 @@ def unber(s):
     >>> unber('\x99a\x89\x12')
     [3297, 1170]
     """
+    if len(s) > 16:  # numpy has a constant overhead, so only for long values
+        return unber_array(s).tolist()
     res = []
     acc = 0
     for char in s:
@@ -228,6 +391,31 @@ def unber(s):
     return res
 
 
+def unber_array(s):
+    # type: (str) -> np.ndarray
+    r""" Vectorized version of `unber`, returning a numpy array of int64
+
+    >>> unber_array('\x00\x83M\x99a\x89\x12')
+    array([   0,  461, 3297, 1170])
+    >>> unber_array('')
+    array([], dtype=int64)
+    """
+    data = np.frombuffer(s, dtype=np.uint8)
+    ends = np.flatnonzero(data < 0x80)
+    if not len(ends):
+        return np.empty(0, dtype=np.int64)
+    # trailing incomplete value is dropped, same as unber does
+    data = data[:ends[-1] + 1]
+    starts = np.empty_like(ends)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    # for every byte, 7 * number of bytes left until the end of its value
+    value_ends = np.repeat(ends, ends - starts + 1)
+    shifts = (value_ends - np.arange(len(data))) * 7
+    chunks = (data & 0x7f).astype(np.int64) << shifts
+    return np.add.reduceat(chunks, starts)
+
+
 def lzf_length(raw_data):
     # type: (str) -> (int, int)
     r""" Get length of uncompressed data from a header of Compress::LZF
@@ -272,8 +460,8 @@ def lzf_length(raw_data):
     return start, usize
 
 
-def decomp(raw_data):
-    # type: (str) -> str
+def decomp(raw_data, dtype=None):
+    # type: (str, Optional[str]) -> str
     """ lzf wrapper to handle perl tweaks in Compress::LZF
     This function extracts uncompressed size header
     and then does usual lzf decompression.
@@ -281,6 +469,8 @@ def decomp(raw_data):
 
     Args:
         raw_data (bytes): data compressed with Perl Compress::LZF
+        dtype (Optional[str]): data type, only used to attribute
+            decompressed bytes in `stats()`
 
     Returns:
         str: unpacked data
@@ -288,9 +478,13 @@ def decomp(raw_data):
     if not raw_data:
         return ""
     elif raw_data[0] == '\x00':
-        return raw_data[1:]
-    start, usize = lzf_length(raw_data)
-    return lzf.decompress(raw_data[start:], usize)
+        data = raw_data[1:]
+    else:
+        start, usize = lzf_length(raw_data)
+        data = lzf.decompress(raw_data[start:], usize)
+    if _STATS.enabled:
+        _STATS.decompressed(dtype, len(data))
+    return data
 
 
 def cached_property(func):
@@ -304,14 +498,128 @@ def cached_property(func):
     return property(wrapper)
 
 
+def sha_array(raw_data):
+    # type: (Optional[str]) -> np.ndarray
+    r""" Zero-copy view of concatenated binary SHAs as an array of S20
+
+    .. Note:: numpy strips trailing null bytes of S20 elements on access,
+        use `.tobytes()` or `sha_hex` to get the exact binary values.
+
+    >>> sha_array('\x01' * 20 + '\x02' * 20).shape
+    (2,)
+    >>> sha_array(None).shape
+    (0,)
+    """
+    if not raw_data:
+        return np.empty(0, dtype='S20')
+    # ignore trailing incomplete SHA, if any
+    return np.frombuffer(raw_data, dtype='S20', count=len(raw_data) // 20)
+
+
+def sha_hex(shas):
+    # type: (np.ndarray) -> tuple
+    r""" Hex encode an array of binary SHAs in bulk
+
+    >>> sha_hex(sha_array('\x01' * 19 + '\x00'))
+    ('0101010101010101010101010101010101010100',)
+    """
+    hex_data = binascii.hexlify(shas.tobytes())
+    return tuple(hex_data[i:i + 40] for i in range(0, len(hex_data), 40))
+
+
 def slice20(raw_data):
     """ Slice raw_data into 20-byte chunks and hex encode each of them
     """
-    if raw_data is None:
-        return ()
+    return sha_hex(sha_array(raw_data))
+
+
+class ShaSet(object):
+    r""" A compact, sorted set of SHA1 hashes
+
+    SHAs are stored as a sorted numpy array of 20 bytes binary strings,
+    which takes ~5x less memory than a tuple of hex strings.
+    Membership is checked by binary search.
+    It supports both hex and binary SHAs on input, but always yields hex:
+
+        >>> shas = ShaSet.from_raw('\x02' * 20 + '\x01' * 20)
+        >>> len(shas)
+        2
+        >>> shas[0]
+        '0101010101010101010101010101010101010101'
+        >>> '\x02' * 20 in shas
+        True
+        >>> '0202020202020202020202020202020202020202' in shas
+        True
+        >>> '0303030303030303030303030303030303030303' in shas
+        False
+        >>> tuple(shas[1:])
+        ('0202020202020202020202020202020202020202',)
+    """
+    __slots__ = ('bin_shas',)
+
+    def __init__(self, bin_shas=None):
+        """
+        Args:
+            bin_shas (Optional[np.ndarray]): a *sorted* array of unique S20
+        """
+        if bin_shas is None:
+            bin_shas = np.empty(0, dtype='S20')
+        self.bin_shas = bin_shas
+
+    @classmethod
+    def from_raw(cls, raw_data):
+        """ Make a ShaSet from concatenated binary SHAs, as stored in
+        relations. Duplicates are removed """
+        # np.unique also makes a sorted copy, so raw_data can be released
+        return cls(np.unique(sha_array(raw_data)))
+
+    @classmethod
+    def from_shas(cls, shas):
+        """ Make a ShaSet from an iterable of hex or binary SHAs """
+        return cls.from_raw(''.join(
+            sha if len(sha) == 20 else binascii.unhexlify(sha)
+            for sha in shas))
+
+    def __len__(self):
+        return len(self.bin_shas)
+
+    def __iter__(self):
+        # hex encode in chunks to avoid a full copy for big sets
+        for i in range(0, len(self.bin_shas), BATCH_SIZE):
+            for sha in sha_hex(self.bin_shas[i:i + BATCH_SIZE]):
+                yield sha
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            if item.step is not None and item.step < 0:
+                raise ValueError("ShaSet slices can't be reversed")
+            return ShaSet(self.bin_shas[item])
+        return sha_hex(self.bin_shas[item:item + 1 or None])[0]
+
+    def __contains__(self, sha):
+        if not isinstance(sha, six.string_types):
+            return False
+        if len(sha) == 40:
+            try:
+                sha = binascii.unhexlify(sha)
+            except (TypeError, ValueError):  # not a hex string
+                return False
+        elif len(sha) != 20:
+            return False
+        i = np.searchsorted(self.bin_shas, sha)
+        # tobytes() to compare without stripping trailing null bytes
+        return i < len(self.bin_shas) \
+            and self.bin_shas[i:i + 1].tobytes() == sha
 
-    return tuple(raw_data[i:i + 20].encode('hex')
-                 for i in range(0, len(raw_data), 20))
+    def __eq__(self, other):
+        return isinstance(other, ShaSet) \
+            and np.array_equal(self.bin_shas, other.bin_shas)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "<ShaSet: %d SHAs>" % len(self)
 
 
 class CommitTimezone(tzinfo):
@@ -335,6 +643,114 @@ class CommitTimezone(tzinfo):
 
 
 DAY_Z = datetime.fromtimestamp(0, CommitTimezone(0, 0))
+# invalid timestamp in columnar results, see Commit.parse_many.
+# Conveniently, it converts to NaT in numpy datetime64
+NAT_TS = np.iinfo(np.int64).min
+# author of synthetic merge commits, excluded from projects
+MERGE_BUTTON = 'GitHub Merge Button <merge-button@github.com>'
+
+
+def _tz_minutes(tz):
+    # type: (str) -> int
+    """ Parse timezone offset of a git timestamp into minutes
+
+    >>> _tz_minutes('+1100'), _tz_minutes('-0130')
+    (660, -90)
+    """
+    if len(tz) != 5 or tz[0] not in '+-' or not tz[1:].isdigit():
+        raise ValueError("Invalid timezone: " + tz)
+    minutes = int(tz[1:3]) * 60 + int(tz[3:])
+    return -minutes if tz[0] == '-' else minutes
+
+
+# timezones are interned, there are only a few dozens of them in practice
+_TIMEZONES = {}
+
+
+def _timezone(minutes):
+    # type: (int) -> CommitTimezone
+    tz = _TIMEZONES.get(minutes)
+    if tz is None:
+        tz = _TIMEZONES[minutes] = CommitTimezone(0, minutes)
+    return tz
+
+
+# the latest known valid timestamp, to avoid calling time.time() every time
+_LATEST_TS = time.time()
+
+
+def _is_future(ts):
+    # type: (int) -> bool
+    global _LATEST_TS
+    if ts <= _LATEST_TS:
+        return False
+    _LATEST_TS = time.time()
+    return ts > _LATEST_TS
+
+
+def parse_commit_ts(timestamp):
+    # type: (str) -> Tuple[int, int]
+    """ Parse date string of authored_at/commited_at into unix epoch and
+    timezone offset in minutes, without creating a datetime object
+
+    >>> parse_commit_ts('1337145807 +1100')
+    (1337145807, 660)
+    """
+    ts, tz = timestamp.split()
+    return int(ts), _tz_minutes(tz)
+
+
+def parse_commit_dates(timestamps):
+    """ Vectorized version of `parse_commit_date`
+
+    Args:
+        timestamps (Iterable[str]): strings like '1337145807 +1100'
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: datetime64[s] UTC timestamps,
+            NaT for invalid or future dates; int16 timezone offsets in minutes
+
+    >>> dts, tzs = parse_commit_dates(['1337145807 +1100', 'x', '0 -0130'])
+    >>> [str(dt) for dt in dts]
+    ['2012-05-16T05:23:27', 'NaT', '1970-01-01T00:00:00']
+    >>> tzs
+    array([660,   0, -90], dtype=int16)
+    """
+    timestamps = list(timestamps)
+    size = len(timestamps)
+    ts = np.full(size, NAT_TS, dtype=np.int64)
+    tzs = np.zeros(size, dtype=np.int16)
+    pairs = [timestamp.split() for timestamp in timestamps]
+    # malformed items are left NaT without shifting the rest
+    idx = np.array([i for i, pair in enumerate(pairs) if len(pair) == 2],
+                   dtype=np.int64)
+    if not len(idx):
+        return ts.astype('datetime64[s]'), tzs
+    ts_tokens = np.array([pairs[i][0] for i in idx])
+    tz_tokens = np.array([pairs[i][1] for i in idx])
+    # there are only a few dozens of distinct timezones,
+    # so they are validated by _tz_minutes one by one
+    tz_values, tz_index = np.unique(tz_tokens, return_inverse=True)
+    tz_minutes = np.zeros(len(tz_values), dtype=np.int16)
+    tz_valid = np.ones(len(tz_values), dtype=bool)
+    for i, tz in enumerate(tz_values):
+        try:
+            tz_minutes[i] = _tz_minutes(tz)
+        except ValueError:
+            tz_valid[i] = False
+    valid = tz_valid[tz_index]
+    idx, ts_tokens = idx[valid], ts_tokens[valid]
+    tzs[idx] = tz_minutes[tz_index[valid]]
+    try:
+        ts[idx] = ts_tokens.astype(np.int64)
+    except (ValueError, OverflowError):  # slow path, parse one by one
+        for i, token in zip(idx, ts_tokens):
+            try:
+                ts[i] = int(token)
+            except (ValueError, OverflowError):  # i.e. doesn't fit int64
+                tzs[i] = 0
+    ts[ts > time.time()] = NAT_TS
+    return ts.astype('datetime64[s]'), tzs
 
 
 def parse_commit_date(timestamp):
@@ -354,50 +770,572 @@ def parse_commit_date(timestamp):
 
     >>> parse_commit_date('1337145807 +1100')
     datetime.datetime(2012, 5, 16, 16, 23, 27, tzinfo=<Timezone: 11:00>)
+    >>> parse_commit_date('1337145807 +0530')
+    datetime.datetime(2012, 5, 16, 10, 53, 27, tzinfo=<Timezone: 05:30>)
     >>> parse_commit_date('3337145807 +1100') is None
     True
     """
-    ts, tz = timestamp.split()
-    sign = -1 if tz.startswith('-') else 1
     try:
-        ts = int(ts)
-        hours, minutes = sign * int(tz[-4:-2]), sign * int(tz[-2])
-        dt = datetime.fromtimestamp(ts, CommitTimezone(hours, minutes))
-    except ValueError:
+        ts, tz = parse_commit_ts(timestamp)
+        dt = datetime.fromtimestamp(ts, _timezone(tz))
+    except (ValueError, OverflowError):
         # i.e. if timestamp or timezone is invalid
         return None
 
     # timestamp is in the future
-    if ts > time.time():
+    if _is_future(ts):
         return None
 
     return dt
 
 
-# Pool of open TokyoCabinet databases to save few milliseconds on opening
-_TCH_POOL = {}
+class Stats(object):
+    """ Low overhead I/O and decompression instrumentation
+
+    Collects per data type counters (lookups, hits, misses, bytes read,
+    bytes decompressed) and log2 latency histograms of .tch opens, .tch
+    reads and blob reads. It is disabled by default, or enabled by
+    setting OSCAR_STATS=1; when disabled, instrumented code only checks
+    a flag.
+
+    >>> s = Stats(enabled=True)
+    >>> s.lookup('commit_random', 'x' * 100)
+    >>> s.lookup('commit_random', None)
+    >>> s.timing('tch_read', 0.0003)
+    >>> snap = s.snapshot()
+    >>> counters = snap['counters']['commit_random']
+    >>> counters['hits'], counters['misses']
+    (1, 1)
+    >>> snap['latency']['tch_read']['buckets']
+    {512: 1}
+    """
+    COUNTERS = ('lookups', 'hits', 'misses', 'bytes_read',
+                'bytes_decompressed')
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.hook = None
+        self.hook_interval = None
+        self._last_hook = time.time()
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._counters = {}  # dtype -> list of COUNTERS values
+            # operation -> [count, total seconds, {log2 us bucket: count}]
+            self._latency = {}
+
+    def _counter(self, dtype):
+        counter = self._counters.get(dtype)
+        if counter is None:
+            counter = self._counters[dtype] = [0] * len(self.COUNTERS)
+        return counter
+
+    def lookup(self, dtype, value):
+        # type: (Optional[str], Optional[str]) -> None
+        """ Record a key lookup, `value` is None if the key was not found """
+        with self._lock:
+            counter = self._counter(dtype)
+            counter[0] += 1
+            if value is None:
+                counter[2] += 1
+            else:
+                counter[1] += 1
+                counter[3] += len(value)
+        self._maybe_call_hook()
+
+    def read(self, dtype, size):
+        # type: (Optional[str], int) -> None
+        """ Record bytes read bypassing key lookups, e.g. blob content """
+        with self._lock:
+            self._counter(dtype)[3] += size
+        self._maybe_call_hook()
+
+    def decompressed(self, dtype, size):
+        # type: (Optional[str], int) -> None
+        with self._lock:
+            self._counter(dtype)[4] += size
+        self._maybe_call_hook()
+
+    def timing(self, operation, seconds):
+        # type: (str, float) -> None
+        """ Record latency of an operation, e.g. 'tch_read' """
+        bucket = 1 << int(seconds * 1000000).bit_length()
+        with self._lock:
+            latency = self._latency.get(operation)
+            if latency is None:
+                latency = self._latency[operation] = [0, 0.0, {}]
+            latency[0] += 1
+            latency[1] += seconds
+            latency[2][bucket] = latency[2].get(bucket, 0) + 1
+        self._maybe_call_hook()
+
+    @contextmanager
+    def timer(self, operation):
+        if not self.enabled:
+            yield
+            return
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.timing(operation, time.time() - started)
+
+    def snapshot(self):
+        # type: () -> dict
+        """ Get a copy of all collected statistics
+
+        Returns:
+            dict: {'counters': {dtype: {counter: value}},
+                   'latency': {operation: {'count': int, 'total': seconds,
+                        'buckets': {upper bound in microseconds: count}}}}.
+                Counters recorded without a data type go to 'other'.
+        """
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'counters': {
+                    dtype or 'other': dict(zip(self.COUNTERS, counter))
+                    for dtype, counter in self._counters.items()},
+                'latency': {
+                    operation: {'count': count, 'total': total,
+                                'buckets': dict(buckets)}
+                    for operation, (count, total, buckets)
+                    in self._latency.items()},
+            }
+
+    def set_hook(self, hook, interval=60):
+        # type: (Optional[Callable[[dict], Any]], Optional[float]) -> None
+        """ Set a function to export snapshots to a metrics system.
+        It is called with a snapshot at most every `interval` seconds from
+        the thread doing I/O, so it should be fast. None to remove the hook.
+        """
+        self.hook = hook
+        self.hook_interval = interval
+        self._last_hook = time.time()
+
+    def _maybe_call_hook(self):
+        if self.hook is None:
+            return
+        now = time.time()
+        with self._lock:
+            if now - self._last_hook < (self.hook_interval or 0):
+                return
+            self._last_hook = now
+        self.hook(self.snapshot())
+
+
+_STATS = Stats(enabled=bool(os.environ.get('OSCAR_STATS')))
+
+
+def stats(reset=False):
+    # type: (bool) -> dict
+    """ Snapshot of I/O and decompression statistics, see `Stats`
+
+    Args:
+        reset (bool): reset statistics after taking the snapshot
+    """
+    snapshot = _STATS.snapshot()
+    if reset:
+        _STATS.reset()
+    return snapshot
+
+
+def enable_stats(enabled=True):
+    # type: (bool) -> None
+    """ Switch I/O and decompression instrumentation on or off """
+    _STATS.enabled = enabled
+
+
+def set_stats_hook(hook, interval=60):
+    # type: (Optional[Callable[[dict], Any]], Optional[float]) -> None
+    """ Export statistics periodically, see `Stats.set_hook` """
+    _STATS.set_hook(hook, interval)
+
+
+class TchPool(object):
+    """ A bounded pool of open read-only TokyoCabinet handles
+
+    Opening a .tch file takes a few milliseconds, so handles are kept open
+    and reused. At most `max_size` handles are kept; the least recently used
+    one is closed when a new one is needed. Handles which are in use at the
+    moment (see `handle()`) are never closed, so the pool might temporarily
+    exceed `max_size` if more handles are used concurrently.
+
+    Pool itself is thread-safe. TokyoCabinet handles are not, unless they
+    are opened with `mutex=True`.
+
+    >>> pool = TchPool(max_size=2)
+    >>> pool.stats()['max_size']
+    2
+    """
+
+    class _Entry(object):
+        __slots__ = ('db', 'refs')
+
+        def __init__(self, db):
+            self.db = db
+            self.refs = 0
+
+    class Lease(object):
+        """ A reference to an open handle, which is not closed by the pool
+        until the lease is released, explicitly (`release()` or exiting
+        the `with` block) or when it is garbage collected.
+        Attributes of the handle (e.g. `get`, `fwmkeys`) are proxied.
+        """
+        def __init__(self, pool, entry):
+            self._pool = pool
+            self._entry = entry
+
+        def release(self):
+            entry, self._entry = self._entry, None
+            if entry is not None:
+                self._pool._release(entry)
+
+        def __getattr__(self, attr):
+            if self._entry is None:
+                raise ValueError("The handle lease has been released")
+            return getattr(self._entry.db, attr)
+
+        def __getitem__(self, key):
+            return self.__getattr__('__getitem__')(key)
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            self.release()
+
+        def __del__(self):
+            self.release()
+
+    def __init__(self, max_size=None, mutex=False):
+        """
+        Args:
+            max_size (Optional[int]): maximum number of open handles to keep,
+                None means no limit
+            mutex (bool): whether to make handles thread-safe (setmutex)
+        """
+        self.max_size = max_size
+        self.mutex = mutex
+        self._entries = OrderedDict()  # path -> _Entry, in LRU order
+        self._lock = threading.Lock()
+        self.hits = self.opens = self.evictions = 0
+
+    def _open(self, path):
+        db = tch.Hash()
+        if self.mutex:  # has to be called before open
+            db.setmutex()
+        if not _STATS.enabled:
+            db.open(path, tch.HDBOREADER | tch.HDBONOLCK)
+            return db
+        started = time.time()
+        db.open(path, tch.HDBOREADER | tch.HDBONOLCK)
+        _STATS.timing('tch_open', time.time() - started)
+        return db
+
+    def _evict(self):
+        # has to be called with self._lock acquired
+        if self.max_size is None:
+            return
+        excess = len(self._entries) - self.max_size
+        if excess <= 0:
+            return
+        victims = []
+        for path, entry in six.iteritems(self._entries):
+            if not entry.refs:  # in use handles can't be closed
+                victims.append(path)
+                if len(victims) == excess:
+                    break
+        for path in victims:
+            self._entries.pop(path).db.close()
+        self.evictions += len(victims)
+
+    def _acquire(self, path):
+        with self._lock:
+            entry = self._entries.pop(path, None)
+            if entry is not None:
+                self.hits += 1
+                self._entries[path] = entry  # move to the end
+                entry.refs += 1
+                return entry
+        # opening might take a while, so it is done without the lock
+        db = self._open(path)
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is None:
+                entry = self._entries[path] = self._Entry(db)
+                self.opens += 1
+            else:  # another thread has opened it in the meantime
+                db.close()
+            entry.refs += 1
+            self._evict()
+            return entry
+
+    def _release(self, entry):
+        with self._lock:
+            entry.refs -= 1
+            if self.max_size is not None \
+                    and len(self._entries) > self.max_size:
+                self._evict()
+
+    @staticmethod
+    def _normalize(path):
+        if not path.endswith('.tch'):
+            path += '.tch'
+        return path
+
+    @contextmanager
+    def handle(self, path):
+        """ Context manager to get an open handle of a .tch file.
+        The handle is guaranteed to stay open until the context is exited.
+        """
+        entry = self._acquire(self._normalize(path))
+        try:
+            yield entry.db
+        finally:
+            self._release(entry)
+
+    def get(self, path):
+        # type: (str) -> TchPool.Lease
+        """ Get a lease on an open handle of a .tch file.
+        The handle stays open while the lease is held, so it is safe to use
+        from multiple threads (given `mutex=True`). Prefer `handle()`,
+        which releases the handle deterministically.
+
+        >>> pool = TchPool(max_size=1)
+        >>> with pool.get('/nonexistent') as db:  # doctest: +SKIP
+        ...     db.get('key')
+        """
+        return self.Lease(self, self._acquire(self._normalize(path)))
+
+    def resize(self, max_size):
+        """ Change the maximum number of open handles """
+        with self._lock:
+            self.max_size = max_size
+            self._evict()
+
+    def close(self):
+        """ Close all handles that are not in use at the moment """
+        with self._lock:
+            for path, entry in list(self._entries.items()):
+                if not entry.refs:
+                    del self._entries[path]
+                    entry.db.close()
+
+    def stats(self):
+        """ Get pool usage statistics
+
+        Returns:
+            dict: number of open handles (size), max_size, number of reused
+                handles (hits), number of opened files (opens) and number of
+                closed handles (evictions)
+        """
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'opens': self.opens,
+                'evictions': self.evictions,
+            }
+
+
+# Pool of open TokyoCabinet databases to save few milliseconds on opening.
+# Since every handle holds a file descriptor and a memory map, the number of
+# open handles is limited (OSCAR_TCH_POOL_SIZE, 0 means no limit).
+# Set OSCAR_TCH_MUTEX to share handles across threads.
+_TCH_POOL = TchPool(
+    max_size=int(os.environ.get('OSCAR_TCH_POOL_SIZE', 256)) or None,
+    mutex=bool(os.environ.get('OSCAR_TCH_MUTEX')))
 
 
 def _get_tch(path):
-    if not path.endswith('.tch'):
-        path += '.tch'
-    if path not in _TCH_POOL:
-        _TCH_POOL[path] = tch.Hash()
-        _TCH_POOL[path].open(path, tch.HDBOREADER | tch.HDBONOLCK)
-        # _TCH_POOL[path].setmutex()
-    return _TCH_POOL[path]
+    # type: (str) -> TchPool.Lease
+    """ Deprecated: use `_TCH_POOL.handle(path)` instead.
+    Returns a refcounted lease, see `TchPool.get` """
+    warnings.warn("_get_tch() is deprecated, use _TCH_POOL.handle()",
+                  DeprecationWarning, stacklevel=2)
+    return _TCH_POOL.get(path)
+
+
+class LRUCache(object):
+    """ A thread-safe LRU cache, bounded by the total weight of values
+
+    >>> cache = LRUCache(10)
+    >>> cache.put('a', 'abcdef')
+    >>> cache.put('b', 'ghijkl')  # 'a' is evicted to fit
+    >>> cache.get('a') is None, cache.get('b')
+    (True, 'ghijkl')
+    >>> cache.stats()['hits'], cache.stats()['misses']
+    (1, 1)
+    """
+    def __init__(self, capacity, weight=len):
+        """
+        Args:
+            capacity (int): maximum total weight of cached values,
+                0 disables the cache
+            weight (Callable[[Any], int]): a function to get weight of a value,
+                e.g. size in bytes
+        """
+        self.capacity = capacity
+        self.weight = weight
+        self._entries = OrderedDict()  # key -> (value, weight), in LRU order
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key, default=None):
+        if not self.capacity:
+            return default
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._entries[key] = entry  # move to the end
+            return entry[0]
+
+    def _evict(self):
+        # has to be called with self._lock acquired
+        while self._size > self.capacity:
+            _, (_, weight) = self._entries.popitem(last=False)
+            self._size -= weight
+            self.evictions += 1
+
+    def put(self, key, value):
+        if not self.capacity:
+            return
+        weight = self.weight(value)
+        if weight > self.capacity:  # would evict everything else
+            return
+        with self._lock:
+            old_entry = self._entries.pop(key, None)
+            if old_entry is not None:
+                self._size -= old_entry[1]
+            self._entries[key] = (value, weight)
+            self._size += weight
+            self._evict()
+
+    def resize(self, capacity):
+        """ Change capacity of the cache, 0 to disable it """
+        with self._lock:
+            self.capacity = capacity
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def stats(self):
+        """ Get cache usage statistics
+
+        Returns:
+            dict: number of entries (count), their total weight (size),
+                capacity, hits, misses and evictions
+        """
+        with self._lock:
+            return {
+                'count': len(self._entries),
+                'size': self._size,
+                'capacity': self.capacity,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+# Decompressed content of commits and trees, shared by all instances.
+# Bounded in bytes by OSCAR_OBJECT_CACHE_SIZE (64Mb by default, 0 disables it)
+_OBJECT_CACHE = LRUCache(
+    int(os.environ.get('OSCAR_OBJECT_CACHE_SIZE', 2 ** 26)))
+
+
+class BlobStore(object):
+    """ Shared read-only access to blob content files
+
+    Every file is opened once and kept open. Reads are positional, i.e. they
+    don't move a shared file pointer, so concurrent reads from different
+    threads are safe without locking: `os.pread` is used where available
+    (Python 3), otherwise files are memory-mapped.
+    """
+    def __init__(self):
+        self._files = {}  # path -> file descriptor or mmap
+        self._lock = threading.Lock()
+
+    def _get(self, path):
+        datafile = self._files.get(path)
+        if datafile is None:
+            with self._lock:
+                datafile = self._files.get(path)
+                if datafile is None:
+                    datafile = self._files[path] = self._open(path)
+        return datafile
+
+    @staticmethod
+    def _open(path):
+        fd = os.open(path, os.O_RDONLY)
+        if hasattr(os, 'pread'):
+            return fd
+        try:
+            return mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        finally:  # mmap keeps its own reference to the file
+            os.close(fd)
+
+    def read(self, path, offset, length):
+        # type: (str, int, int) -> str
+        """ Read `length` bytes starting at `offset` of the file """
+        datafile = self._get(path)
+        enabled = _STATS.enabled
+        if enabled:
+            started = time.time()
+        if isinstance(datafile, mmap.mmap):
+            data = datafile[offset:offset + length]
+        else:
+            data = os.pread(datafile, length, offset)
+        if enabled:
+            _STATS.timing('blob_read', time.time() - started)
+            _STATS.read('blob_data', len(data))
+        return data
+
+    def close(self):
+        """ Close all open files """
+        with self._lock:
+            for datafile in self._files.values():
+                if isinstance(datafile, mmap.mmap):
+                    datafile.close()
+                else:
+                    os.close(datafile)
+            self._files = {}
+
+
+_BLOB_STORE = BlobStore()
 
 
-def read_tch(path, key, silent=False):
+def read_tch(path, key, silent=False, dtype=None):
     """ Read a value from a Tokyo Cabinet file by the specified key
-    Main purpose of this method is to cached open .tch handlers
-    in _TCH_POOL to speedup reads
+    Main purpose of this method is to reuse open .tch handles
+    from _TCH_POOL to speedup reads
+
+    `dtype` is only used to attribute the lookup in `stats()`
     """
 
+    started = None  # handle opens are timed separately, as tch_open
     try:
-        return _get_tch(path)[key]
+        with _TCH_POOL.handle(path) as db:
+            if _STATS.enabled:
+                started = time.time()
+            value = db[key]
     except:
-        return None
+        value = None
+    if _STATS.enabled:
+        if started is not None:
+            _STATS.timing('tch_read', time.time() - started)
+        _STATS.lookup(dtype, value)
+    return value
         # raise IOError("Tokyocabinet file " + path + " not found")
     # except KeyError:
     #   if silent:
@@ -406,17 +1344,1091 @@ def read_tch(path, key, silent=False):
 
 
 def tch_keys(path, key_prefix=''):
-    return _get_tch(path).fwmkeys(key_prefix)
+    with _TCH_POOL.handle(path) as db:
+        return db.fwmkeys(key_prefix)
+
+
+# TokyoCabinet hash database format, see tchdb.c
+_TCH_MAGIC = 'ToKyO CaBiNeT'
+_TCH_HEADER_SIZE = 256
+_TCH_REC_MAGIC = 0xc8
+_TCH_FREE_MAGIC = 0xb0
+# HDBTDEFLATE | HDBTBZIP | HDBTTCBS | HDBTEXCODEC
+_TCH_COMPRESSED = 2 | 4 | 8 | 16
+
+
+def _tch_varint(buf, pos):
+    # type: (str, int) -> Tuple[int, int]
+    """ Read a TokyoCabinet variable length number, return it and the new
+    position. Bytes with the sign bit set carry 7 bits, the last byte
+    has the sign bit clear.
+
+    >>> _tch_varint('\\x05', 0), _tch_varint('\\xfe\\x01', 0)
+    ((5, 1), (129, 2))
+    """
+    num = 0
+    base = 1
+    while True:
+        c = ord(buf[pos])
+        pos += 1
+        if c < 128:
+            return num + c * base, pos
+        num += base * (255 - c)  # i.e. -(signed_c + 1)
+        base <<= 7
+
+
+def _tch_records(path):
+    """ Iterate (key, value) pairs of a .tch file in the storage order,
+    by parsing the file directly. Memory use is constant since records
+    are read from a memory-mapped file one by one.
+
+    Raises:
+        ValueError: if the file is not a TokyoCabinet hash database
+            or records are compressed
+    """
+    with open(path, 'rb') as fh:
+        header = fh.read(_TCH_HEADER_SIZE)
+        if not header.startswith(_TCH_MAGIC):
+            raise ValueError("Not a TokyoCabinet hash database: " + path)
+        opts = ord(header[36])
+        if opts & _TCH_COMPRESSED:
+            raise ValueError("Compressed records are not supported: " + path)
+        # HDBTLARGE: 64 bit record pointers
+        ptr_size = 8 if opts & 1 else 4
+        fsiz, frec = struct.unpack_from('<QQ', header, 56)
+        fsiz = min(fsiz, os.fstat(fh.fileno()).st_size)
+        if frec >= fsiz:  # empty database
+            return
+        mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        offset = frec
+        while offset < fsiz:
+            magic = ord(mm[offset])
+            if magic == _TCH_FREE_MAGIC:
+                offset += struct.unpack_from('<I', mm, offset + 1)[0]
+                continue
+            if magic != _TCH_REC_MAGIC:
+                raise ValueError("Corrupt record at %d: %s" % (offset, path))
+            # magic, hash, left and right children pointers
+            pos = offset + 2 + 2 * ptr_size
+            padding = struct.unpack_from('<H', mm, pos)[0]
+            key_size, pos = _tch_varint(mm, pos + 2)
+            value_size, pos = _tch_varint(mm, pos)
+            yield mm[pos:pos + key_size], \
+                mm[pos + key_size:pos + key_size + value_size]
+            offset = pos + key_size + value_size + padding
+    finally:
+        mm.close()
+
+
+def tch_iter(path, values=False, start_after=None):
+    """ Stream keys (or key/value pairs) of a .tch file in constant memory
+
+    Unlike `tch_keys`, it doesn't build the list of all keys first, so the
+    first key is available right away. If the file can't be parsed
+    directly (e.g. compressed records), it falls back to `tch_keys`.
+
+    Args:
+        path (str): path to the .tch file
+        values (bool): yield (key, raw value) pairs instead of keys
+        start_after (Optional[str]): resume iteration after this key
+
+    Yields:
+        Union[str, Tuple[str, str]]: keys or (key, raw value) pairs
+
+    Raises:
+        KeyError: if `start_after` is not in the file. Nothing is yielded
+            in this case
+    """
+    try:
+        records = _tch_records(path)
+        first = next(records, None)
+    except (ValueError, IOError, OSError):
+        records = first = None
+    if records is None:  # fall back to the TokyoCabinet API
+        def _records():
+            with _TCH_POOL.handle(path) as db:
+                for key in db.fwmkeys(''):
+                    yield key, db.get(key) if values else None
+        records = _records()
+    elif first is not None:
+        records = itertools.chain([first], records)
+
+    skipping = start_after is not None
+    for key, value in records:
+        if skipping:
+            skipping = key != start_after
+            continue
+        yield (key, value) if values else key
+    if skipping:
+        raise KeyError(start_after)
+
+
+def iter_relation(dtype, start_after=None, decode=True):
+    """ Stream all (key, value) pairs of a relation, shard by shard
+
+    Args:
+        dtype (str): relation name, one of `RELATION_DECODERS` if `decode`
+        start_after (Optional[str]): resume iteration after this key
+        decode (bool): decode values with the relation decoder,
+            otherwise yield raw values
+
+    Yields:
+        Tuple[str, Union[str, list]]: key and the (decoded) value
+
+    Raises:
+        KeyError: if `start_after` is not in the relation
+    """
+    decoder = RELATION_DECODERS[dtype] if decode else None
+    path, prefix_length = PATHS[dtype]
+    first_shard = 0
+    if start_after is not None:
+        first_shard = _shard(start_after, prefix_length, not _sha_keyed(dtype))
+    for shard in range(first_shard, 2 ** prefix_length):
+        shard_path = path.format(key=shard)
+        if not os.path.isfile(shard_path):
+            continue
+        for key, value in tch_iter(shard_path, values=True,
+                                   start_after=start_after):
+            yield key, decoder(value, dtype) if decoder else value
+        start_after = None
+
+
+def _shard(object_key, prefix_length, use_fnv=False):
+    # type: (str, int, bool) -> int
+    """ Get shard number of an object key, i.e. {key} in path templates """
+    p = fnvhash.fnv1a_32(object_key) if use_fnv else ord(object_key[0])
+    return p & (2**prefix_length - 1)
 
 
 def resolve_path(dtype, object_key, use_fnv=False):
     # type: (str, str, bool) -> str
     """ Get path to a file using data type and object key (for sharding) """
     path, prefix_length = PATHS[dtype]
+    return path.format(key=_shard(object_key, prefix_length, use_fnv))
+
+
+def read_tch_many(dtype, keys, use_fnv=False):
+    # type: (str, Iterable[str], bool) -> list
+    """ Read values of many keys of the same data type at once
+
+    Keys are grouped by shard first, so every .tch file is resolved and
+    looked up in the pool only once per call rather than once per key,
+    as it happens with a series of `read_tch` calls.
+
+    Args:
+        dtype (str): data type, e.g. 'commit_random' or 'project_commits'
+        keys (Iterable[str]): object keys. For git objects, these are
+            20 bytes binary SHAs
+        use_fnv (bool): shard keys by FNV hash (files, projects, authors)
+            rather than by the first byte (git objects)
+
+    Returns:
+        list: raw values in the same order as `keys`, with None for keys
+            that were not found
+    """
+    keys = list(keys)
+    path, prefix_length = PATHS[dtype]
+    shards = {}
+    for i, key in enumerate(keys):
+        shards.setdefault(
+            _shard(key, prefix_length, use_fnv), []).append(i)
+
+    values = [None] * len(keys)
+    enabled = _STATS.enabled
+    for prefix, indexes in shards.items():
+        try:
+            with _TCH_POOL.handle(path.format(key=prefix)) as db:
+                for i in indexes:
+                    if enabled:
+                        started = time.time()
+                    values[i] = db.get(keys[i])
+                    if enabled:
+                        _STATS.timing('tch_read', time.time() - started)
+                        _STATS.lookup(dtype, values[i])
+        except tch.error:  # same as read_tch, missing file -> missing keys
+            if enabled:
+                for i in indexes:
+                    _STATS.lookup(dtype, None)
+            continue
+    return values
+
+
+def _chunks(iterable, size):
+    """ Split an iterable into lists of at most `size` elements """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _decode_shas(raw_data, dtype=None):
+    # type: (Optional[str], Optional[str]) -> List[str]
+    """ Decode concatenated binary SHAs, e.g. `project_commits` """
+    raw_data = raw_data or ''
+    return [raw_data[i:i + 20]
+            for i in range(0, len(raw_data) // 20 * 20, 20)]
+
+
+def _decode_names(raw_data, dtype=None):
+    # type: (Optional[str], Optional[str]) -> List[str]
+    """ Decode compressed semicolon separated names, e.g. `commit_projects`.
+    `dtype` is only used to attribute decompressed bytes in `stats()` """
+    data = decomp(raw_data, dtype)
+    return [name for name in (data and data.split(";")) or []
+            if name and name != 'EMPTY']
+
+
+# decoders of relations values into lists of neighbors,
+# used for bulk processing of whole relations
+RELATION_DECODERS = {
+    'commit_children': _decode_shas,
+    'commit_parent': _decode_shas,
+    'commit_blobs': _decode_shas,
+    'author_commits': _decode_shas,
+    'author_blob': _decode_shas,
+    'project_commits': _decode_shas,
+    'blob_commits': _decode_shas,
+    'file_commits': _decode_shas,
+    'file_blobs': _decode_shas,
+    'commit_projects': _decode_names,
+    'commit_files': _decode_names,
+    'author_projects': _decode_names,
+    'author_files': _decode_names,
+    'project_authors': _decode_names,
+    'file_authors': _decode_names,
+    'blob_files': _decode_names,
+}
+
+
+def _sha_keyed(dtype):
+    # type: (str) -> bool
+    """ Whether keys of a relation are binary SHAs rather than names """
+    return dtype.split('_', 1)[0] in ('commit', 'blob', 'tree')
+
+
+def _map_file(fname, dtype):
+    """ Read-only memory map of a binary file as a numpy array """
+    if not os.path.getsize(fname):  # mmap can't map empty files
+        return np.empty(0, dtype=dtype)
+    return np.memmap(fname, dtype=dtype, mode='r')
+
+
+class _NodeTable(object):
+    """ Relation keys or values written to `<name>.bin`, either as S20
+    binary SHAs or as concatenated names with int64 offsets in
+    `<name>_ptr.bin`. Offsets are buffered and written in bulk.
+    """
+    def __init__(self, out_dir, name, sha):
+        self.sha = sha
+        self.data = open(os.path.join(out_dir, name + '.bin'), 'wb')
+        self.ptr = None if sha else open(
+            os.path.join(out_dir, name + '_ptr.bin'), 'wb')
+        self.size = 0
+        self._offset = 0
+        self._ptr_buffer = [0]
+
+    def add(self, key):
+        # type: (str) -> int
+        self.data.write(key)
+        if self.ptr:
+            self._offset += len(key)
+            self._ptr_buffer.append(self._offset)
+            if len(self._ptr_buffer) >= BATCH_SIZE:
+                self._flush()
+        self.size += 1
+        return self.size - 1
+
+    def _flush(self):
+        np.array(self._ptr_buffer, dtype=np.int64).tofile(self.ptr)
+        self._ptr_buffer = []
+
+    def close(self):
+        self.data.close()
+        if self.ptr:
+            self._flush()
+            self.ptr.close()
+
+
+class _NodeView(object):
+    """ Read-only memory-mapped sequence of a table written by `_NodeTable`
+    """
+    def __init__(self, path, name, sha):
+        fname = os.path.join(path, name)
+        if sha:
+            self.data = _map_file(fname + '.bin', 'S20')
+            self.ptr = None
+        else:
+            self.data = _map_file(fname + '.bin', np.uint8)
+            self.ptr = _map_file(fname + '_ptr.bin', np.int64)
+
+    def __len__(self):
+        return len(self.data) if self.ptr is None else len(self.ptr) - 1
+
+    def __getitem__(self, idx):
+        # type: (int) -> str
+        if self.ptr is None:
+            return self.data[idx:idx + 1].tobytes()
+        return self.data[self.ptr[idx]:self.ptr[idx + 1]].tobytes()
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+
+class _PermutedView(object):
+    """ Sequence of `view` items in the order of `order` indexes,
+    to binary search a table by its sort permutation """
+    def __init__(self, view, order):
+        self.view = view
+        self.order = order
+
+    def __len__(self):
+        return len(self.order)
+
+    def __getitem__(self, idx):
+        # type: (int) -> str
+        return self.view[self.order[idx]]
+
+
+def _export_run(out_dir, name, values, sha):
+    """ Write sorted distinct values into a temporary node table """
+    table = _NodeTable(out_dir, name, sha)
+    for value in sorted(set(values)):
+        table.add(value)
+    table.close()
+    return name
+
+
+def _export_key_run(out_dir, name, pairs, sha):
+    """ Write (key, row) pairs sorted by key into a temporary node table,
+    and row numbers into `<name>_rows.bin` """
+    pairs.sort()
+    table = _NodeTable(out_dir, name, sha)
+    for key, _ in pairs:
+        table.add(key)
+    table.close()
+    np.array([row for _, row in pairs], dtype=np.int64).tofile(
+        os.path.join(out_dir, name + '_rows.bin'))
+    return name
+
+
+def export_relation_csr(dtype, out_dir, batch_size=100 * BATCH_SIZE):
+    # type: (str, str, int) -> dict
+    """ Export a whole relation into memory-mappable CSR adjacency files
+
+    Relation is streamed shard by shard and distinct neighbors are found by
+    an external merge sort, so memory use is proportional to `batch_size`
+    rather than the relation size or the number of distinct neighbors.
+    Files written to `out_dir`:
+
+        - `src.bin`: keys, either S20 binary SHAs or concatenated names
+          with int64 offsets in `src_ptr.bin`. Row i of the CSR matrix
+          corresponds to the i-th key
+        - `src_order.bin`: int64 row numbers sorted by key, to look up
+          keys by binary search
+        - `dst.bin` (and `dst_ptr.bin`): distinct neighbors, sorted,
+          in the same format
+        - `offsets.bin`: int64 array, neighbors of the i-th key are
+          `neighbors[offsets[i]:offsets[i + 1]]`
+        - `neighbors.bin`: int64 indexes into the `dst` table
+        - `meta.json`: relation name and array sizes
+
+    Args:
+        dtype (str): relation name, one of `RELATION_DECODERS`
+        out_dir (str): output directory, created if it does not exist
+        batch_size (int): number of edges to sort and map at once
+
+    Returns:
+        dict: content of `meta.json`
+
+    Use `load_relation_csr` to read the exported relation:
+
+        >>> export_relation_csr('project_commits', 'p2c')  # doctest: +SKIP
+        >>> p2c = load_relation_csr('p2c')  # doctest: +SKIP
+    """
+    decoder = RELATION_DECODERS[dtype]
+    sha_keys = _sha_keyed(dtype)
+    sha_values = decoder is _decode_shas
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    src = _NodeTable(out_dir, 'src', sha_keys)
+    # neighbors of all keys, in order, to be replaced by dst indexes later
+    edges = _NodeTable(out_dir, '_edges', sha_values)
+    runs = []  # temporary tables of sorted distinct neighbors
+    key_runs = []  # temporary tables of sorted keys and their rows
+    pending = []
+    pending_keys = []
+    offsets = [0]
+    with open(os.path.join(out_dir, 'offsets.bin'), 'wb') as offsets_fh:
+        for key, values in iter_relation(dtype):
+            pending_keys.append((key, src.add(key)))  # keys are unique
+            if len(pending_keys) >= batch_size:
+                key_runs.append(_export_key_run(
+                    out_dir, '_keys%d' % len(key_runs), pending_keys,
+                    sha_keys))
+                pending_keys = []
+            for value in values:
+                edges.add(value)
+            pending.extend(values)
+            offsets.append(edges.size)
+            if len(pending) >= batch_size:
+                runs.append(_export_run(
+                    out_dir, '_run%d' % len(runs), pending, sha_values))
+                pending = []
+            if len(offsets) >= BATCH_SIZE:
+                np.array(offsets, dtype=np.int64).tofile(offsets_fh)
+                offsets = []
+        np.array(offsets, dtype=np.int64).tofile(offsets_fh)
+    if pending:
+        runs.append(_export_run(
+            out_dir, '_run%d' % len(runs), pending, sha_values))
+    if pending_keys:
+        key_runs.append(_export_key_run(
+            out_dir, '_keys%d' % len(key_runs), pending_keys, sha_keys))
+    src.close()
+    edges.close()
+
+    with open(os.path.join(out_dir, 'src_order.bin'), 'wb') as order_fh:
+        order = []
+        for _, row in heapq.merge(*[six.moves.zip(
+                _NodeView(out_dir, run, sha_keys),
+                _map_file(os.path.join(out_dir, run + '_rows.bin'),
+                          np.int64)) for run in key_runs]):
+            order.append(row)
+            if len(order) >= BATCH_SIZE:
+                np.array(order, dtype=np.int64).tofile(order_fh)
+                order = []
+        np.array(order, dtype=np.int64).tofile(order_fh)
+
+    dst = _NodeTable(out_dir, 'dst', sha_values)
+    last = None
+    for value in heapq.merge(
+            *[_NodeView(out_dir, run, sha_values) for run in runs]):
+        if value != last:
+            dst.add(value)
+            last = value
+    dst.close()
+
+    # dst is sorted, so neighbor indexes are found by binary search
+    dst_view = _NodeView(out_dir, 'dst', sha_values)
+    edges_view = _NodeView(out_dir, '_edges', sha_values)
+    with open(os.path.join(out_dir, 'neighbors.bin'), 'wb') as neighbors:
+        for start in range(0, len(edges_view), batch_size):
+            stop = min(start + batch_size, len(edges_view))
+            if sha_values:
+                ids = np.searchsorted(
+                    dst_view.data, edges_view.data[start:stop])
+            else:
+                chunk = [edges_view[i] for i in range(start, stop)]
+                ids = {value: bisect.bisect_left(dst_view, value)
+                       for value in set(chunk)}
+                ids = np.array([ids[value] for value in chunk],
+                               dtype=np.int64)
+            ids.astype(np.int64).tofile(neighbors)
+    dst_view = edges_view = None  # unmap temporary files
+    for name in runs + ['_edges']:
+        os.remove(os.path.join(out_dir, name + '.bin'))
+        if not sha_values:
+            os.remove(os.path.join(out_dir, name + '_ptr.bin'))
+    for name in key_runs:
+        os.remove(os.path.join(out_dir, name + '.bin'))
+        os.remove(os.path.join(out_dir, name + '_rows.bin'))
+        if not sha_keys:
+            os.remove(os.path.join(out_dir, name + '_ptr.bin'))
+
+    meta = {
+        'dtype': dtype,
+        'src_sha': src.sha,
+        'dst_sha': dst.sha,
+        'src_count': src.size,
+        'dst_count': dst.size,
+        'edge_count': edges.size,
+    }
+    with open(os.path.join(out_dir, 'meta.json'), 'w') as fh:
+        json.dump(meta, fh)
+    return meta
+
+
+class RelationCSR(object):
+    """ Read-only memory-mapped relation exported by `export_relation_csr`
+
+    Attributes:
+        offsets, neighbors (np.memmap): CSR adjacency, neighbors of the
+            i-th key are `neighbors[offsets[i]:offsets[i + 1]]`,
+            i.e. indexes of the `dst` table
+        src_order (np.memmap): row numbers sorted by key
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as fh:
+            self.meta = json.load(fh)
+        self.dtype = self.meta['dtype']
+        self.offsets = _map_file(os.path.join(path, 'offsets.bin'), np.int64)
+        self.neighbors = _map_file(
+            os.path.join(path, 'neighbors.bin'), np.int64)
+        self.src_order = _map_file(
+            os.path.join(path, 'src_order.bin'), np.int64)
+        self._tables = {}
+
+    def _table(self, name):
+        # type: (str) -> _NodeView
+        if name not in self._tables:
+            self._tables[name] = _NodeView(
+                self.path, name, self.meta[name + '_sha'])
+        return self._tables[name]
+
+    def _key(self, name, idx):
+        return self._table(name)[idx]
+
+    def __len__(self):
+        return self.meta['src_count']
+
+    def src(self, idx):
+        # type: (int) -> str
+        """ Key of the i-th row, binary SHA or name """
+        return self._key('src', idx)
+
+    def dst(self, idx):
+        # type: (int) -> str
+        """ Neighbor by its index in the `dst` table """
+        return self._key('dst', idx)
+
+    def src_row(self, key):
+        # type: (str) -> int
+        """ Row number of a key, found by binary search over `src_order`
+
+        Raises:
+            KeyError: if the key is not in the relation
+        """
+        src = self._table('src')
+        if src.ptr is None:
+            pos = int(np.searchsorted(src.data, key, sorter=self.src_order))
+        else:
+            pos = bisect.bisect_left(_PermutedView(src, self.src_order), key)
+        if pos < len(self.src_order) and src[self.src_order[pos]] == key:
+            return int(self.src_order[pos])
+        raise KeyError(key)
+
+    def degrees(self):
+        # type: () -> np.ndarray
+        """ Number of neighbors of every key """
+        return np.diff(self.offsets)
+
+    def __getitem__(self, key):
+        # type: (str) -> List[str]
+        """ Decoded neighbors of a key (binary SHA or name) """
+        if self.meta['src_sha'] and len(key) == 40:
+            key = binascii.unhexlify(key)
+        idx = self.src_row(key)
+        return [self.dst(i) for i in
+                self.neighbors[self.offsets[idx]:self.offsets[idx + 1]]]
+
+
+def load_relation_csr(path):
+    # type: (str) -> RelationCSR
+    """ Memory-map a relation exported by `export_relation_csr` """
+    return RelationCSR(path)
+
+
+def _check_join_path(path):
+    # type: (Sequence[str]) -> None
+    """ Make sure values of every relation are keys of the next one """
+    for dtype in path:
+        if dtype not in RELATION_DECODERS:
+            raise ValueError("Unsupported relation: %s" % dtype)
+    for dtype, next_dtype in zip(path, path[1:]):
+        if (RELATION_DECODERS[dtype] is _decode_shas) != \
+                _sha_keyed(next_dtype):
+            raise ValueError("Values of %s are not keys of %s"
+                             % (dtype, next_dtype))
+
+
+def _join_keys(dtype, keys):
+    # type: (str, Iterable[str]) -> Iterable[str]
+    """ Convert hex SHAs to binary for SHA-keyed relations """
+    if not _sha_keyed(dtype):
+        return keys
+    return [binascii.unhexlify(key) if len(key) == 40 else key
+            for key in keys]
+
+
+def _join_hop(dtype, keys, max_fanout=None, batch_size=BATCH_SIZE):
+    """ Look up neighbors of many keys in bulk, see `read_tch_many`
+
+    Yields:
+        Tuple[str, list]: key and its decoded neighbors,
+            at most `max_fanout` of them
+    """
+    decoder = RELATION_DECODERS[dtype]
+    use_fnv = not _sha_keyed(dtype)
+    for chunk in _chunks(keys, batch_size):
+        for key, raw_data in zip(chunk, read_tch_many(dtype, chunk, use_fnv)):
+            neighbors = decoder(raw_data, dtype)
+            if max_fanout is not None:
+                neighbors = neighbors[:max_fanout]
+            yield key, neighbors
+
+
+def join(seeds, path, max_fanout=None, batch_size=10 * BATCH_SIZE):
+    # type: (Iterable[str], Sequence[str], Optional[int], int) -> Counter
+    """ Follow a chain of relations from a set of seed keys
+
+    Every hop looks up each distinct key only once, and lookups are
+    batched and grouped by shard (see `read_tch_many`), no matter how many
+    paths lead to a key.
+
+    Args:
+        seeds (Iterable[str]): keys of the first relation, e.g. author names
+            or (hex or binary) commit SHAs
+        path (Sequence[str]): relation names, e.g.
+            `('author_commits', 'commit_projects')`
+        max_fanout (Optional[int]): use at most this many neighbors
+            of every node, to limit the cost of very large nodes
+        batch_size (int): number of keys to look up at once
+
+    Returns:
+        Counter: nodes of the final frontier (hex SHAs or names) with the
+            number of distinct paths leading to them from the seeds.
+            E.g. for author_commits -> commit_projects, it is the number
+            of the seed authors' commits in every project.
+
+    >>> join(['Marat <valiev.m@gmail.com>'],
+    ...      ['author_commits', 'commit_projects'])  # doctest: +SKIP
+    Counter({'user2589_minicms': 112, ...})
+    """
+    path = tuple(path)
+    _check_join_path(path)
+    counts = Counter(_join_keys(path[0], seeds))
+    for dtype in path:
+        next_counts = Counter()
+        for key, neighbors in _join_hop(
+                dtype, list(counts), max_fanout, batch_size):
+            count = counts[key]
+            for neighbor in neighbors:
+                next_counts[neighbor] += count
+        counts = next_counts
+
+    if RELATION_DECODERS[path[-1]] is _decode_shas:
+        return Counter({binascii.hexlify(key): count
+                        for key, count in counts.items()})
+    return counts
+
+
+def join_iter(seeds, path, max_fanout=None, batch_size=10 * BATCH_SIZE):
+    # type: (Iterable[str], Sequence[str], Optional[int], int) -> Iterator[str]
+    """ Streaming version of `join`: distinct nodes of the final frontier
+    are yielded as soon as they are found, without counts.
+    Intermediate frontiers are still collected to deduplicate lookups.
+
+    >>> for project in join_iter(['Marat <valiev.m@gmail.com>'],
+    ...         ['author_commits', 'commit_projects']):  # doctest: +SKIP
+    ...     print(project)
+    """
+    path = tuple(path)
+    _check_join_path(path)
+    frontier = set(_join_keys(path[0], seeds))
+    for dtype in path[:-1]:
+        frontier = set(neighbor for _, neighbors in _join_hop(
+            dtype, frontier, max_fanout, batch_size)
+            for neighbor in neighbors)
+
+    to_hex = RELATION_DECODERS[path[-1]] is _decode_shas
+    seen = set()
+    for _, neighbors in _join_hop(path[-1], frontier, max_fanout, batch_size):
+        for neighbor in neighbors:
+            if neighbor not in seen:
+                seen.add(neighbor)
+                yield binascii.hexlify(neighbor) if to_hex else neighbor
+
+
+try:
+    import asyncio
+except ImportError:  # Python 2
+    asyncio = None
+
+try:
+    from concurrent.futures import Future
+    from concurrent.futures import TimeoutError as FutureTimeoutError
+except ImportError:  # Python 2 without the futures backport
+    Future = None
+
+    class FutureTimeoutError(Exception):
+        """ Same as `concurrent.futures.TimeoutError` """
+
+_StopAsyncIteration = getattr(six.moves.builtins, 'StopAsyncIteration',
+                              StopIteration)
+
+
+class _Future(object):
+    """ Minimal stand-in for `concurrent.futures.Future` """
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._result = self._exception = None
+        self._callbacks = []
+
+    def done(self):
+        return self._event.is_set()
+
+    def cancelled(self):
+        return False
+
+    def result(self, timeout=None):
+        if not self._event.wait(timeout):
+            raise FutureTimeoutError("Timeout waiting for the result")
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        if not self._event.wait(timeout):
+            raise FutureTimeoutError("Timeout waiting for the result")
+        return self._exception
+
+    def add_done_callback(self, fn):
+        with self._lock:
+            if not self.done():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def _finish(self):
+        with self._lock:
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            fn(self)
+
+    def set_result(self, result):
+        self._result = result
+        self._finish()
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._finish()
+
+
+if Future is None:
+    Future = _Future
+
+
+def _awaitable(future):
+    """ Wrap a future to be used with `await`, if asyncio is available.
+    Otherwise, the future is returned as is, so `.result()` can be used """
+    if asyncio is None:
+        return future
+    return asyncio.wrap_future(future)
+
+
+def _running_loop():
+    """ asyncio event loop running in the current thread, if any """
+    get_loop = asyncio and (getattr(asyncio, 'get_running_loop', None) or
+                            getattr(asyncio, '_get_running_loop', None))
+    if get_loop is None:
+        return None
+    try:
+        return get_loop()
+    except RuntimeError:  # get_running_loop() outside of a coroutine
+        return None
+
+
+def _then(future, func):
+    """ Future of `func(result)` of another future """
+    result = Future()
+
+    def done(f):
+        try:
+            result.set_result(func(f.result()))
+        except Exception as e:
+            result.set_exception(e)
+    future.add_done_callback(done)
+    return result
+
+
+def _resolved(result=None, exception=None):
+    future = Future()
+    if exception is not None:
+        future.set_exception(exception)
+    else:
+        future.set_result(result)
+    return future
+
+
+class BatchExecutor(object):
+    """ Bounded pool of threads doing blocking I/O for one storage backend
+
+    Requests submitted at about the same time are grouped into batches,
+    so a hundred concurrent `Commit.afetch()` calls result in a single
+    `read_tch_many` call rather than a hundred `read_tch` calls.
+
+    Args:
+        concurrency (int): number of worker threads, i.e. maximum number
+            of I/O batches in flight
+        batch_size (int): maximum number of requests in one batch
+        max_pending (int): maximum number of queued requests. Submitting
+            more blocks until some of them are processed. On a running
+            asyncio event loop, the blocking put is done by the loop's
+            default executor instead, so the loop is never stalled
+
+    >>> executor = BatchExecutor(2)
+    >>> executor.submit(lambda keys: [k * 2 for k in keys], 21).result()
+    42
+    """
+    def __init__(self, concurrency, batch_size=BATCH_SIZE, max_pending=10000):
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self._queue = Queue.Queue(max_pending)
+        self._threads = set()
+        self._lock = threading.Lock()
+
+    def _ensure_workers(self):
+        if len(self._threads) >= self.concurrency:
+            return
+        with self._lock:
+            while len(self._threads) < self.concurrency:
+                thread = threading.Thread(target=self._worker)
+                thread.daemon = True
+                self._threads.add(thread)
+                thread.start()
+
+    def resize(self, concurrency):
+        # type: (int) -> None
+        """ Change the number of worker threads. Extra threads exit
+        after finishing their current batches """
+        self.concurrency = concurrency
+        self._ensure_workers()
+        for _ in range(len(self._threads) - concurrency):
+            self._put(None)  # tells one worker to exit
+
+    def _put(self, item):
+        try:
+            self._queue.put_nowait(item)
+            return
+        except Queue.Full:
+            pass
+        loop = _running_loop()
+        if loop is None:
+            self._queue.put(item)
+        else:  # callers await the request future anyway
+            loop.run_in_executor(None, self._queue.put, item)
+
+    def submit(self, func, key):
+        """ Schedule a batchable request
+
+        Args:
+            func (Callable[[list], list]): function taking a list of keys and
+                returning a list of results in the same order. Requests with
+                the same function are batched together
+            key: request key
+
+        Returns:
+            Future: result of `func` for the key
+        """
+        future = Future()
+        self._ensure_workers()
+        self._put((func, key, future))
+        return future
+
+    def call(self, func):
+        """ Schedule a single call of `func()`, without batching """
+        future = Future()
+        self._ensure_workers()
+        self._put((None, func, future))
+        return future
+
+    def _worker(self):
+        try:
+            self._process()
+        finally:  # so that _ensure_workers() can replace this thread
+            with self._lock:
+                self._threads.discard(threading.current_thread())
+
+    def _process(self):
+        while True:
+            item = self._queue.get()
+            if item is None:  # see resize()
+                return
+            batch = [item]
+            while len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get_nowait()
+                except Queue.Empty:
+                    break
+                if item is None:  # leave it for another worker
+                    self._queue.put(item)
+                    break
+                batch.append(item)
+
+            groups = OrderedDict()
+            for func, key, future in batch:
+                if func is None:  # see call()
+                    self._run([future], lambda keys: [key()], [None])
+                else:
+                    groups.setdefault(func, []).append((key, future))
+            for func, requests in groups.items():
+                keys, futures = zip(*requests)
+                self._run(futures, func, list(keys))
+
+    @staticmethod
+    def _run(futures, func, keys):
+        """ Call `func` on a batch of keys and resolve the futures.
+        It never raises, so that a bad batch doesn't kill the worker """
+        def resolve(future, result=None, exception=None):
+            try:
+                if future.done():  # e.g. cancelled meanwhile
+                    return
+                if exception is not None:
+                    future.set_exception(exception)
+                else:
+                    future.set_result(result)
+            except Exception:  # cancelled between the check and the call
+                pass
+
+        try:
+            results = func(keys)
+            if len(results) != len(keys):
+                raise ValueError("Expected %d results, got %d"
+                                 % (len(keys), len(results)))
+            for future, result in zip(futures, results):
+                resolve(future, result)
+        except Exception as e:
+            for future in futures:  # resolved ones are skipped
+                resolve(future, exception=e)
+
+
+# storage backend -> concurrency. Random access stores and basemaps are on
+# SSD and handle many concurrent reads, while blob content is on HDD
+ASYNC_CONCURRENCY = {
+    'ssd': int(os.environ.get('OSCAR_SSD_CONCURRENCY') or 16),
+    'hdd': int(os.environ.get('OSCAR_HDD_CONCURRENCY') or 4),
+}
+_EXECUTORS = {}
+_EXECUTORS_LOCK = threading.Lock()
+
+
+def _executor(backend):
+    # type: (str) -> BatchExecutor
+    if backend not in _EXECUTORS:
+        with _EXECUTORS_LOCK:
+            if backend not in _EXECUTORS:
+                _EXECUTORS[backend] = BatchExecutor(ASYNC_CONCURRENCY[backend])
+    return _EXECUTORS[backend]
+
+
+def set_async_concurrency(backend, concurrency):
+    # type: (str, int) -> None
+    """ Set the number of concurrent I/O batches of a storage backend,
+    'ssd' (.tch files) or 'hdd' (blob content) """
+    ASYNC_CONCURRENCY[backend] = concurrency
+    if backend in _EXECUTORS:
+        _EXECUTORS[backend].resize(concurrency)
+
+
+# batch functions for BatchExecutor.submit. They have to be the same
+# objects for all requests of the same kind, to be batched together
+_TCH_READERS = {}
+
+
+def _tch_reader(dtype, use_fnv):
+    key = (dtype, use_fnv)
+    if key not in _TCH_READERS:
+        _TCH_READERS[key] = lambda keys: read_tch_many(dtype, keys, use_fnv)
+    return _TCH_READERS[key]
 
-    p = fnvhash.fnv1a_32(object_key) if use_fnv else ord(object_key[0])
-    prefix = p & (2**prefix_length - 1)
-    return path.format(key=prefix)
+
+def _fetch_commits(bin_shas):
+    return Commit.fetch_many(bin_shas)
+
+
+def _preload_commits(commits):
+    for commit, data in zip(
+            commits, Commit._read_many([c.bin_sha for c in commits])):
+        if data is not None:
+            commit._data = data
+
+
+def _fetch_blob_data(bin_shas):
+    return [blob and blob.data for blob in Blob.fetch_many(bin_shas)]
+
+
+class AsyncIterator(object):
+    """ Adapter of a blocking iterable to `async for`
+
+    Items are produced in chunks by a worker thread. The next chunk is
+    requested by the consumer as soon as it takes an item from the current
+    one, so I/O overlaps with processing. It implements the protocol
+    without async syntax, so the module still compiles on Python 2, but
+    `async for` itself requires asyncio and is not covered by the tests:
+
+        >>> p = Project('user2589_minicms')
+        >>> async for commit in p.acommits():  # doctest: +SKIP
+        ...     print(commit.message)
+
+    Args:
+        iterable (Iterable): blocking iterable, only advanced by one
+            thread at a time
+        backend (str): storage backend to use, see `ASYNC_CONCURRENCY`
+        chunk_size (int): number of items to produce at once
+        prepare (Optional[Callable[[list], Any]]): function to call on
+            every chunk in the worker thread, e.g. to preload content
+    """
+    def __init__(self, iterable, backend='ssd', chunk_size=BATCH_SIZE,
+                 prepare=None):
+        self._chunks = _chunks(iterable, chunk_size)
+        self._executor = _executor(backend)
+        self._prepare = prepare
+        self._buffer = []
+        self._pending = None
+        self._exhausted = False
+
+    def _next_chunk(self):
+        chunk = next(self._chunks, [])
+        if chunk and self._prepare is not None:
+            self._prepare(chunk)
+        return chunk
+
+    def _prefetch(self):
+        if self._pending is None and not self._exhausted:
+            self._pending = self._executor.call(self._next_chunk)
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        if self._buffer:
+            item = self._buffer.pop()
+            # done by the consumer, since a worker thread might block
+            # on the full executor queue. On the event loop it never
+            # blocks, see BatchExecutor._put()
+            self._prefetch()
+            return _awaitable(_resolved(item))
+        if self._exhausted:
+            return _awaitable(_resolved(exception=_StopAsyncIteration()))
+
+        self._prefetch()
+        pending, self._pending = self._pending, None
+        future = Future()
+
+        def chunk_ready(chunk_future):
+            try:
+                chunk = chunk_future.result()
+            except Exception as e:
+                future.set_exception(e)
+                return
+            if not chunk:
+                self._exhausted = True
+                future.set_exception(_StopAsyncIteration())
+                return
+            self._buffer = chunk[:0:-1]  # reversed, to pop from the end
+            future.set_result(chunk[0])
+
+        pending.add_done_callback(chunk_ready)
+        return _awaitable(future)
 
 
 class _Base(object):
@@ -462,54 +2474,282 @@ class _Base(object):
 
     def read_tch(self, dtype, silent=True):
         """ Resolve the path and read .tch"""
-        return read_tch(self.resolve_path(dtype), self.key, silent)
+        return read_tch(self.resolve_path(dtype), self.key, silent, dtype)
+
+    def aread_tch(self, dtype):
+        """ Awaitable version of `read_tch`, see `BatchExecutor` """
+        return _awaitable(_executor('ssd').submit(
+            _tch_reader(dtype, self.use_fnv_keys), self.key))
 
     @classmethod
-    def all(cls):
+    def _shard_count(cls):
+        """ Number of shards to iterate in `all()` """
+        if not cls._keys_registry_dtype:
+            raise NotImplementedError
+        base_path, prefix_length = PATHS[cls._keys_registry_dtype]
+        return 2 ** prefix_length
+
+    @classmethod
+    def _iter_shard(cls, shard, start_after=None):
+        """ Iterate all objects of the given type in one shard """
+        base_path, prefix_length = PATHS[cls._keys_registry_dtype]
+        for key in tch_iter(base_path.format(key=shard),
+                            start_after=start_after):
+            yield cls(key)
+
+    @classmethod
+    def all(cls, start_after=None):
         """ Iterate all objects of the given type
 
         This might be useful to get a list of all projects, or a list of
-        all file names.
+        all file names. Keys are streamed, so iteration starts right away
+        and takes constant memory.
+
+        Args:
+            start_after (Optional[str]): resume iteration after this key,
+                e.g. the last one processed by an interrupted job
 
         Yields:
             Project: a project
         """
-        if not cls._keys_registry_dtype:
-            raise NotImplemented
+        first_shard = 0
+        if start_after is not None:
+            base_path, prefix_length = PATHS[cls._keys_registry_dtype]
+            first_shard = _shard(start_after, prefix_length, cls.use_fnv_keys)
+        for shard in range(first_shard, cls._shard_count()):
+            for obj in cls._iter_shard(shard, start_after):
+                yield obj
+            start_after = None
 
-        base_path, prefix_length = PATHS[cls._keys_registry_dtype]
-        for file_prefix in range(2 ** prefix_length):
-            tch_path = base_path.format(key=file_prefix)
-            for key in tch_keys(tch_path):
-                yield cls(key)
+    @classmethod
+    def all_parallel(cls, func, workers=None, shards=None, queue_size=100,
+                     progress=None):
+        """ Apply a function to all objects of the given type in parallel
+
+        Shards are processed by a pool of worker processes. Results are
+        passed back through a bounded queue, so slow consumers don't cause
+        workers to accumulate results in memory.
+        Order of results is not guaranteed.
+
+        Args:
+            func (Callable[[_Base], Any]): function to apply to every object.
+                None results are skipped, so it can be used as a filter.
+                Since workers are forked, it doesn't have to be picklable,
+                but results do.
+            workers (Optional[int]): number of worker processes,
+                by default the number of CPUs
+            shards (Optional[Iterable[int]]): shards to process, all by default
+            queue_size (int): maximum number of result batches
+                waiting to be consumed
+            progress (Optional[Callable[[int, int], Any]]): a callback,
+                which is called with (shard, number of objects processed)
+                every time a shard is complete
+
+        Yields:
+            Any: non-None results of func
+
+        >>> for sha in Commit.all_parallel(  # doctest: +SKIP
+        ...         lambda c: c.sha if not c.parent_shas else None):
+        ...     print(sha)
+        """
+        shard_count = cls._shard_count()
+        shards = range(shard_count) if shards is None else list(shards)
+        for shard in shards:
+            if not 0 <= shard < shard_count:
+                raise ValueError("Invalid shard: %s" % shard)
+        workers = min(workers or multiprocessing.cpu_count(), len(shards))
+
+        tasks = multiprocessing.Queue()
+        for shard in shards:
+            tasks.put(shard)
+        for _ in range(workers):
+            tasks.put(None)  # stop signal
+        results = multiprocessing.Queue(maxsize=queue_size)
+        processes = [multiprocessing.Process(
+                        target=_scan_worker, args=(cls, func, tasks, results))
+                     for _ in range(workers)]
+        for process in processes:
+            process.daemon = True
+            process.start()
+
+        remaining = len(shards)
+        try:
+            while remaining:
+                try:
+                    status, shard, payload = results.get(timeout=1)
+                except Queue.Empty:
+                    if any(process.exitcode for process in processes):
+                        raise RuntimeError("A scan worker has crashed")
+                    continue
+                if status == _SCAN_RESULTS:
+                    for result in payload:
+                        yield result
+                elif status == _SCAN_DONE:
+                    remaining -= 1
+                    if progress is not None:
+                        progress(shard, payload)
+                else:
+                    raise RuntimeError(
+                        "Failed to scan shard %d:\n%s" % (shard, payload))
+        finally:
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+                process.join()
+
+
+_SCAN_RESULTS, _SCAN_DONE, _SCAN_ERROR = range(3)
+
+
+def _scan_worker(cls, func, tasks, results, batch_size=100):
+    """ Worker process of _Base.all_parallel """
+    # handles inherited from the parent process are not safe to share
+    _TCH_POOL.close()
+    _BLOB_STORE.close()
+    for shard in iter(tasks.get, None):
+        count = 0
+        batch = []
+        try:
+            for obj in cls._iter_shard(shard):
+                result = func(obj)
+                count += 1
+                if result is None:
+                    continue
+                batch.append(result)
+                if len(batch) >= batch_size:
+                    results.put((_SCAN_RESULTS, shard, batch))
+                    batch = []
+        except Exception:
+            results.put((_SCAN_ERROR, shard, traceback.format_exc()))
+            return
+        if batch:
+            results.put((_SCAN_RESULTS, shard, batch))
+        results.put((_SCAN_DONE, shard, count))
+
+
+# offset, compressed length and SHA from a line of sequential storage .idx
+# file: "number;offset;compressed_length;[full_length;]sha[;...]"
+_IDX_LINE = re.compile(r"^[^;\n]*;(\d+);(\d+);(?:[^;\n]*;)?"
+                       r"([0-9a-fA-F]{40})(?:;[^\n]*)?$", re.M)
+# .idx files are parsed in chunks of this many bytes to bound memory use
+_IDX_CHUNK_SIZE = 2 ** 24
 
 
 class GitObject(_Base):
     use_fnv_keys = False
+    # (mmap, offset, length) of compressed content, see all(lazy=True)
+    _raw_location = None
 
     @classmethod
-    def all(cls):
-        """ Iterate ALL objects of this type (all projects, all times) """
+    def _shard_count(cls):
         base_idx_path, prefix_length = PATHS[cls.type + '_sequential_idx']
-        base_bin_path, prefix_length = PATHS[cls.type + '_sequential_bin']
-        for key in range(2**prefix_length):
-            idx_path = base_idx_path.format(key=key)
-            bin_path = base_bin_path.format(key=key)
-            datafile = open(bin_path)
-            for line in open(idx_path):
-                chunks = line.strip().split(";")
-                if len(chunks) > 4:  # cls.type == "blob":
-                    # usually, it's true for blobs;
-                    # however, some blobs follow common pattern
-                    offset, comp_length, full_length, sha = chunks[1:5]
+        return 2 ** prefix_length
+
+    @classmethod
+    def _shard_index(cls, key):
+        """ Parse .idx file of a sequential storage shard in chunks
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray, str]: offsets and lengths of
+                compressed objects in .bin file and concatenated binary SHAs
+
+        Raises:
+            ValueError: if the .idx file has malformed lines
+        """
+        base_idx_path, prefix_length = PATHS[cls.type + '_sequential_idx']
+        idx_path = base_idx_path.format(key=key)
+        offsets, comp_lengths, shas = [], [], []
+        lines_before = 0  # number of lines in previous chunks
+        tail = ''  # incomplete last line of the previous chunk
+        with open(idx_path) as fh:
+            while True:
+                block = fh.read(_IDX_CHUNK_SIZE)
+                if block:
+                    tail += block
+                    end = tail.rfind('\n') + 1
+                    if not end:
+                        continue
+                    content, tail = tail[:end], tail[end:]
+                elif tail:  # last line without a trailing newline
+                    content, tail = tail, ''
                 else:
-                    offset, comp_length, sha = chunks[1:4]
+                    break
+                entries = _IDX_LINE.findall(content)
+                lines = content.count('\n') + (not content.endswith('\n'))
+                if len(entries) != lines:
+                    # slow path, only to report the offending line
+                    for lineno, line in enumerate(content.split('\n'),
+                                                  lines_before + 1):
+                        if line and not _IDX_LINE.match(line):
+                            raise ValueError("Malformed line %d in %s: %r"
+                                             % (lineno, idx_path, line))
+                lines_before += lines
+                if entries:
+                    chunk_offsets, chunk_lengths, chunk_shas = zip(*entries)
+                    offsets.append(np.array(chunk_offsets).astype(np.int64))
+                    comp_lengths.append(
+                        np.array(chunk_lengths).astype(np.int64))
+                    shas.append(binascii.unhexlify(''.join(chunk_shas)))
+        if not offsets:
+            return (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64),
+                    '')
+        return (np.concatenate(offsets), np.concatenate(comp_lengths),
+                ''.join(shas))
+
+    @classmethod
+    def _iter_shard_lazy(cls, key):
+        offsets, lengths, bin_shas = cls._shard_index(key)
+        if not len(offsets):
+            return
+        base_bin_path, prefix_length = PATHS[cls.type + '_sequential_bin']
+        with open(base_bin_path.format(key=key), 'rb') as fh:
+            # objects keep a reference, so it is unmapped when all are gone
+            datafile = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        for i, (offset, length) in enumerate(
+                zip(offsets.tolist(), lengths.tolist())):
+            obj = cls(bin_shas[i * 20:(i + 1) * 20])
+            obj._raw_location = (datafile, offset, length)
+            yield obj
+
+    @classmethod
+    def _iter_shard(cls, key, lazy=False):
+        if lazy:
+            for obj in cls._iter_shard_lazy(key):
+                yield obj
+            return
+        base_idx_path, prefix_length = PATHS[cls.type + '_sequential_idx']
+        base_bin_path, prefix_length = PATHS[cls.type + '_sequential_bin']
+        idx_path = base_idx_path.format(key=key)
+        bin_path = base_bin_path.format(key=key)
+        datafile = open(bin_path)
+        for line in open(idx_path):
+            chunks = line.strip().split(";")
+            if len(chunks) > 4:  # cls.type == "blob":
+                # usually, it's true for blobs;
+                # however, some blobs follow common pattern
+                offset, comp_length, full_length, sha = chunks[1:5]
+            else:
+                offset, comp_length, sha = chunks[1:4]
+
+            obj = cls(sha)
+            obj._data = decomp(datafile.read(int(comp_length)),
+                               cls.type + '_sequential_bin')
 
-                obj = cls(sha)
-                obj._data = decomp(datafile.read(int(comp_length)))
+            yield obj
+        datafile.close()
+
+    @classmethod
+    def all(cls, lazy=False):
+        """ Iterate ALL objects of this type (all projects, all times)
 
+        Args:
+            lazy (bool): memory-map storage files and only decompress
+                object content when `.data` is accessed. This is much faster
+                if most objects are filtered out by SHA.
+        """
+        for key in range(cls._shard_count()):
+            for obj in cls._iter_shard(key, lazy):
                 yield obj
-            datafile.close()
 
     def __init__(self, sha):
         """
@@ -538,14 +2778,70 @@ class GitObject(_Base):
 
     def read_tch(self, dtype, silent=True):
         """ Resolve the path and read .tch"""
-        return read_tch(self.resolve_path(dtype), self.bin_sha, silent)
+        return read_tch(self.resolve_path(dtype), self.bin_sha, silent, dtype)
+
+    def aread_tch(self, dtype):
+        """ Awaitable version of `read_tch`, see `BatchExecutor` """
+        return _awaitable(_executor('ssd').submit(
+            _tch_reader(dtype, self.use_fnv_keys), self.bin_sha))
 
     @cached_property
     def data(self):
+        if self._raw_location is not None:  # see all(lazy=True)
+            datafile, offset, length = self._raw_location
+            return decomp(datafile[offset:offset + length],
+                          self.type + '_sequential_bin')
         if self.type not in ('commit', 'tree'):
             raise NotImplementedError
-        # default implementation will only work for commits and trees
-        return decomp(self.read_tch(self.type + '_random', silent=False))
+        data = _OBJECT_CACHE.get(self.bin_sha)
+        if data is None:
+            # default implementation will only work for commits and trees
+            dtype = self.type + '_random'
+            data = decomp(self.read_tch(dtype, silent=False), dtype)
+            if data:
+                _OBJECT_CACHE.put(self.bin_sha, data)
+        return data
+
+    @classmethod
+    def fetch_many(cls, shas):
+        """ Instantiate many objects and read their content in bulk
+
+        It is equivalent to `[cls(sha) for sha in shas]` followed by
+        accessing `.data` of each object, but all reads are grouped by shard
+        (see `read_tch_many`).
+
+        Args:
+            shas (Iterable[str]): hex or binary SHAs
+
+        Returns:
+            list: objects in the same order as `shas`, with None in place
+                of objects missing in the dataset
+        """
+        objs = [cls(sha) for sha in shas]
+        for i, data in enumerate(
+                cls._read_many([obj.bin_sha for obj in objs])):
+            if data is None:
+                objs[i] = None
+            else:
+                objs[i]._data = data
+        return objs
+
+    @classmethod
+    def _read_many(cls, bin_shas):
+        # type: (List[str]) -> List[Optional[str]]
+        """ Read content of many objects of this type in bulk,
+        bypassing object instantiation. See `fetch_many` for details. """
+        if cls.type not in ('commit', 'tree'):
+            raise NotImplementedError
+        result = [_OBJECT_CACHE.get(bin_sha) for bin_sha in bin_shas]
+        missing = [i for i, data in enumerate(result) if data is None]
+        values = read_tch_many(
+            cls.type + '_random', [bin_shas[i] for i in missing])
+        for i, raw_data in zip(missing, values):
+            if raw_data is not None:
+                result[i] = decomp(raw_data, cls.type + '_random')
+                _OBJECT_CACHE.put(bin_shas[i], result[i])
+        return result
 
     @classmethod
     def string_sha(cls, data):
@@ -636,14 +2932,83 @@ class Blob(GitObject):
             raise ObjectNotFound('Blob data not found (bad sha?)')
         return offset, length
 
+    @classmethod
+    def fetch_many(cls, shas, data=True, as_dict=False, max_gap=2 ** 16,
+                   max_read=2 ** 24):
+        """ Instantiate many blobs and read their content in bulk
+
+        First, positions of all blobs are looked up (see `read_tch_many`).
+        Then, reads are sorted by file and offset, so that the disk is read
+        sequentially rather than randomly, and neighbouring blobs are read
+        at once.
+
+        Args:
+            shas (Iterable[str]): hex or binary SHAs
+            data (bool): whether to read blob content. If False, only blob
+                positions are looked up and `.data` is read on first access
+            as_dict (bool): return a dict {sha: Blob} instead of a list
+            max_gap (int): blobs separated by at most this number of bytes
+                are read at once, discarding the gap
+            max_read (int): maximum number of bytes to read at once,
+                unless it is a single blob
+
+        Returns:
+            Union[list, dict]: Blob objects in the same order as `shas`,
+                with None in place of blobs missing in the dataset.
+                If `as_dict` is set, it is a dict of hex SHAs to Blobs,
+                without missing blobs.
+        """
+        objs = [cls(sha) for sha in shas]
+        values = read_tch_many('blob_offset', [obj.bin_sha for obj in objs])
+        for i, raw_data in enumerate(values):
+            position = raw_data and unber(raw_data)
+            if not position or len(position) != 2:
+                objs[i] = None
+            else:
+                objs[i]._position = tuple(position)
+
+        if data:
+            blobs = sorted(
+                (obj for obj in objs if obj is not None),
+                key=lambda obj: (obj.resolve_path('blob_data'), obj.position))
+            for path, chunk in _coalesce_reads(blobs, max_gap, max_read):
+                start = chunk[0].position[0]
+                end = max(obj.position[0] + obj.position[1] for obj in chunk)
+                buf = _BLOB_STORE.read(path, start, end - start)
+                for obj in chunk:
+                    offset, length = obj.position
+                    obj._data = decomp(
+                        buf[offset - start:offset - start + length],
+                        'blob_data')
+
+        if as_dict:
+            return {obj.sha: obj for obj in objs if obj is not None}
+        return objs
+
+    def adata(self):
+        """ Awaitable blob content. Concurrent requests are read in batches,
+        see `BatchExecutor` and `fetch_many`
+
+            >>> data = await Blob(sha).adata()  # doctest: +SKIP
+        """
+        if '_data' in self.__dict__:
+            return _awaitable(_resolved(self._data))
+
+        def cache(data):
+            if data is None:
+                raise ObjectNotFound('Blob data not found (bad sha?)')
+            self._data = data
+            return data
+        return _awaitable(_then(
+            _executor('hdd').submit(_fetch_blob_data, self.bin_sha), cache))
+
     @cached_property
     def data(self):
         """ Content of the blob """
         offset, length = self.position
-        # no caching here to stay thread-safe
-        with open(self.resolve_path('blob_data'), 'rb') as fh:
-            fh.seek(offset)
-            return decomp(fh.read(length))
+        return decomp(
+            _BLOB_STORE.read(self.resolve_path('blob_data'), offset, length),
+            'blob_data')
 
     @cached_property
     def commit_shas(self):
@@ -654,6 +3019,12 @@ class Blob(GitObject):
         """
         return slice20(self.read_tch('blob_commits'))
 
+    @cached_property
+    def commit_sha_set(self):
+        """ Same as `commit_shas`, but as a compact `ShaSet`.
+        Use it for big blobs or membership checks """
+        return ShaSet.from_raw(self.read_tch('blob_commits'))
+
     @property
     def commits(self):
         """ Commits where this blob has been added or changed
@@ -663,6 +3034,341 @@ class Blob(GitObject):
         return (Commit(bin_sha) for bin_sha in self.commit_shas)
 
 
+def _coalesce_reads(blobs, max_gap, max_read):
+    """ Group blobs sorted by (path, offset) into chunks to read at once
+
+    Yields:
+        Tuple[str, List[Blob]]: path and blobs to read from it
+    """
+    path = chunk = None
+    chunk_end = 0
+    for blob in blobs:
+        blob_path = blob.resolve_path('blob_data')
+        offset, length = blob.position
+        if chunk and blob_path == path and offset - chunk_end <= max_gap \
+                and offset + length - chunk[0].position[0] <= max_read:
+            chunk.append(blob)
+            chunk_end = max(chunk_end, offset + length)
+            continue
+        if chunk:
+            yield path, chunk
+        path, chunk, chunk_end = blob_path, [blob], offset + length
+    if chunk:
+        yield path, chunk
+
+
+def parse_tree(data):
+    # type: (str) -> tuple
+    r""" Parse binary git tree object
+
+    Format description:  https://stackoverflow.com/questions/14790681/
+        mode   (ASCII encoded decimal)
+        SPACE (\0x20)
+        filename
+        NULL (\x00)
+        20-byte binary hash
+
+    Args:
+        data (str): uncompressed tree object content
+
+    Returns:
+        Tuple[Tuple[str, str, str]]: (mode, filename, binary sha) 3-tuples
+
+    >>> parse_tree('100644 a.py\x00' + 'a' * 20 + '40000 b\x00' + 'b' * 20)
+    ... # doctest: +NORMALIZE_WHITESPACE
+    (('100644', 'a.py', 'aaaaaaaaaaaaaaaaaaaa'),
+     ('40000', 'b', 'bbbbbbbbbbbbbbbbbbbb'))
+    """
+    entries = []
+    find = data.find
+    i = 0
+    while i < len(data):
+        space = find(" ", i)
+        null = find("\x00", space + 1)
+        if space < 0 or null < 0:
+            raise ValueError("Corrupted tree object")
+        entries.append((data[i:space], data[space + 1:null],
+                        data[null + 1:null + 21]))
+        i = null + 21
+    return tuple(entries)
+
+
+# Flattened content of subtrees, shared by all trees (and thus commits)
+# including them. Root trees are not cached, as they are rarely shared.
+# Capacity is the total number of files in cached subtrees, see Tree.files
+_SUBTREE_FILES = LRUCache(
+    int(os.environ.get('OSCAR_SUBTREE_CACHE_SIZE', 2 ** 19)))
+# Recursive number of files in subtrees, see Tree.__len__.
+# Capacity is the number of cached subtrees
+_SUBTREE_COUNTS = LRUCache(
+    int(os.environ.get('OSCAR_SUBTREE_COUNT_CACHE_SIZE', 2 ** 16)),
+    weight=lambda count: 1)
+
+
+def _tree_files(tree, cache=True):
+    # type: (Tree, bool) -> dict
+    """ Get {path: blob sha} of all files under the tree.
+    Subtrees are memoized by SHA so that every unique subtree is only
+    expanded once.
+
+    Args:
+        tree (Tree): the tree to expand
+        cache (bool): whether to cache the result. If True, the result is
+            shared and should not be modified.
+    """
+    files = _SUBTREE_FILES.get(tree.bin_sha) if cache else None
+    if files is None:
+        files = {}
+        for mode, fname, bin_sha in tree.entries:
+            if mode == "40000":
+                prefix = fname + '/'
+                for path, sha in _tree_files(Tree(bin_sha)).items():
+                    files[prefix + path] = sha
+            else:
+                files[fname] = binascii.hexlify(bin_sha)
+        if cache:
+            _SUBTREE_FILES.put(tree.bin_sha, files)
+    return files
+
+
+def _tree_file_count(tree, cache=True):
+    # type: (Tree, bool) -> int
+    """ Get recursive number of files under the tree.
+    Subtrees are memoized by SHA, see `_tree_files`
+    """
+    count = _SUBTREE_COUNTS.get(tree.bin_sha) if cache else None
+    if count is None:
+        count = 0
+        for mode, fname, bin_sha in tree.entries:
+            if mode == "40000":
+                count += _tree_file_count(Tree(bin_sha))
+            else:
+                count += 1
+        if cache:
+            _SUBTREE_COUNTS.put(tree.bin_sha, count)
+    return count
+
+
+def tree_diff(old_tree, new_tree, prefix=''):
+    """ Compare two trees recursively, skipping subtrees with the same SHA
+
+    Since only changed subtrees are expanded, it takes time proportional to
+    the size of the change rather than the size of the trees.
+
+    Args:
+        old_tree (Tree): tree before the change
+        new_tree (Tree): tree after the change
+        prefix (str): path of both trees, to prepend to file names
+
+    Yields:
+        Tuple[Optional[str], Optional[str], Optional[str], Optional[str]]:
+            `(old_path, new_path, old_sha, new_sha)`, with None in place of
+            path and sha of added/deleted files, same as `Commit.__sub__`.
+            Renames are not detected, i.e. old_path and new_path are always
+            the same if both are present.
+    """
+    old_entries = {fname: (mode, bin_sha)
+                   for mode, fname, bin_sha in old_tree.entries}
+    new_entries = {fname: (mode, bin_sha)
+                   for mode, fname, bin_sha in new_tree.entries}
+
+    for fname, (old_mode, old_sha) in old_entries.items():
+        path = prefix + fname
+        new_mode, new_sha = new_entries.get(fname, (None, None))
+        if old_sha == new_sha:  # unchanged, including whole subtrees
+            continue
+        if old_mode == "40000" and new_mode == "40000":
+            for change in tree_diff(Tree(old_sha), Tree(new_sha), path + '/'):
+                yield change
+        elif new_mode is not None \
+                and old_mode != "40000" and new_mode != "40000":
+            yield (path, path,
+                   binascii.hexlify(old_sha), binascii.hexlify(new_sha))
+        else:  # deleted, or replaced by an entry of another type
+            for fpath, sha in _entry_files(old_mode, path, old_sha):
+                yield fpath, None, sha, None
+            if new_mode is not None:
+                for fpath, sha in _entry_files(new_mode, path, new_sha):
+                    yield None, fpath, None, sha
+
+    for fname, (new_mode, new_sha) in new_entries.items():
+        if fname not in old_entries:
+            for fpath, sha in _entry_files(new_mode, prefix + fname, new_sha):
+                yield None, fpath, None, sha
+
+
+# see Commit.__sub__, same as git diff.renameLimit
+RENAME_LIMIT = 1000
+# number of hash functions in MinHash signatures used to detect renames
+_MINHASH_SIZE = 64
+_MINHASH_PRIME = (1 << 31) - 1
+_MINHASH_RANDOM = np.random.RandomState(1337)
+_MINHASH_A = _MINHASH_RANDOM.randint(
+    1, _MINHASH_PRIME, size=(_MINHASH_SIZE, 1)).astype(np.uint64)
+_MINHASH_B = _MINHASH_RANDOM.randint(
+    0, _MINHASH_PRIME, size=(_MINHASH_SIZE, 1)).astype(np.uint64)
+
+
+def _minhash(content):
+    # type: (str) -> np.ndarray
+    """ Get MinHash signature of a set of lines of the content.
+    Share of equal positions in two signatures estimates Jaccard similarity
+    of the line sets.
+    """
+    lines = set(line.strip() for line in content.splitlines())
+    lines.discard('')
+    if not lines:
+        return np.full(_MINHASH_SIZE, _MINHASH_PRIME, dtype=np.uint64)
+    hashes = np.fromiter((zlib.crc32(line) & 0xffffffff for line in lines),
+                         dtype=np.uint64, count=len(lines))
+    # a * hash < 2**63, so there is no overflow
+    return ((_MINHASH_A * hashes + _MINHASH_B) % _MINHASH_PRIME).min(axis=1)
+
+
+def _rename_candidates(added, deleted, sizes, signatures, threshold):
+    """ Find candidate rename pairs, comparing each added file only to
+    deleted files with a close enough size.
+
+    Args:
+        added (List[Tuple[str, str]]): (path, blob sha) of added files
+        deleted (List[Tuple[str, str]]): (path, blob sha) of deleted files
+        sizes (Dict[str, int]): blob sha -> content size
+        signatures (Dict[str, np.ndarray]): blob sha -> MinHash signature
+        threshold (float): minimum similarity, see Commit.__sub__
+
+    Returns:
+        List[Tuple[float, int, int]]: (similarity, added idx, deleted idx)
+    """
+    if not added or not deleted:
+        return []
+    order = np.argsort([sizes[sha] for _, sha in deleted], kind='mergesort')
+    deleted_sizes = np.array([sizes[deleted[j][1]] for j in order])
+    deleted_signatures = np.array(
+        [signatures[deleted[j][1]] for j in order]).reshape(
+            len(deleted), _MINHASH_SIZE)
+    # the upper bound of similarity by size difference,
+    # 2 * min(a, b) / (a + b) (same as difflib real_quick_ratio), is above
+    # the threshold only if b is within [a * t / (2 - t), a * (2 - t) / t]
+    low_ratio = max(threshold, 0.0) / (2.0 - threshold)
+    candidates = []
+    for i, (fname, sha) in enumerate(added):
+        size = sizes[sha]
+        lo = np.searchsorted(deleted_sizes, size * low_ratio, 'left')
+        hi = np.searchsorted(deleted_sizes, size / low_ratio, 'right') \
+            if low_ratio else len(deleted_sizes)
+        if lo >= hi:
+            continue
+        window = slice(lo, hi)
+        size_ratio = 2.0 * np.minimum(deleted_sizes[window], size) \
+            / np.maximum(deleted_sizes[window] + size, 1)
+        jaccard = (deleted_signatures[window] == signatures[sha]).mean(axis=1)
+        # convert Jaccard to Dice coefficient, similar to difflib ratio
+        similarity = 2 * jaccard / (1 + jaccard)
+        for k in np.flatnonzero(
+                (size_ratio > threshold) & (similarity > threshold)):
+            candidates.append((similarity[k], i, order[lo + k]))
+    return candidates
+
+
+def _detect_renames(added_files, deleted_files, threshold, rename_limit):
+    """ Match added and deleted files of a commit as renames
+
+    Exact matches (same blob SHA) are found first. Remaining files are
+    compared by content: content of all candidates is read in bulk,
+    similarity is estimated by comparing MinHash signatures of lines.
+    Files are first paired within buckets of the same extension, then
+    files left unmatched are paired across extensions. In both cases,
+    only files of a similar size are compared.
+    If threshold is 1 or above, renames are not detected at all.
+
+    Args:
+        added_files (Dict[str, str]): path -> blob sha of added files
+        deleted_files (Dict[str, str]): path -> blob sha of deleted files
+        threshold (float): minimum similarity of renamed files, see
+            Commit.__sub__
+        rename_limit (int): see Commit.__sub__
+
+    Yields:
+        Tuple[Optional[str], Optional[str], Optional[str], Optional[str]]:
+            4-tuples, see Commit.__sub__
+    """
+    added_files = dict(added_files)
+    deleted_files = dict(deleted_files)
+
+    if threshold < 1:
+        deleted_by_sha = {}
+        for fname, sha in deleted_files.items():
+            deleted_by_sha.setdefault(sha, []).append(fname)
+        for added_fname, sha in list(added_files.items()):
+            if deleted_by_sha.get(sha):
+                deleted_fname = deleted_by_sha[sha].pop()
+                del added_files[added_fname]
+                del deleted_files[deleted_fname]
+                yield deleted_fname, added_fname, sha, sha
+
+    if threshold < 1 and added_files and deleted_files \
+            and len(added_files) * len(deleted_files) <= rename_limit ** 2:
+        blobs = Blob.fetch_many(
+            set(added_files.values()) | set(deleted_files.values()),
+            as_dict=True)
+        sizes = {sha: len(blob.data) for sha, blob in blobs.items()}
+        signatures = {sha: _minhash(blob.data) for sha, blob in blobs.items()}
+
+        def buckets(files):
+            result = {}
+            for fname, sha in files.items():
+                if sha in blobs:
+                    result.setdefault(os.path.splitext(fname)[1], []).append(
+                        (fname, sha))
+            return result
+
+        added_buckets = buckets(added_files)
+        deleted_buckets = buckets(deleted_files)
+        # same extension first, then whatever is left across extensions
+        passes = [(added_buckets[ext], deleted_buckets[ext])
+                  for ext in sorted(added_buckets) if ext in deleted_buckets]
+        passes.append((None, None))
+        for added, deleted in passes:
+            if added is None:
+                added = [(fname, sha) for fname, sha in added_files.items()
+                         if sha in blobs]
+                deleted = [(fname, sha) for fname, sha in deleted_files.items()
+                           if sha in blobs]
+            else:
+                added = [item for item in added if item[0] in added_files]
+                deleted = [item for item in deleted
+                           if item[0] in deleted_files]
+            candidates = _rename_candidates(
+                added, deleted, sizes, signatures, threshold)
+            matched_added = set()
+            matched_deleted = set()
+            for similarity, i, j in sorted(candidates, reverse=True):
+                if i in matched_added or j in matched_deleted:
+                    continue
+                matched_added.add(i)
+                matched_deleted.add(j)
+                (added_fname, added_sha), (deleted_fname, deleted_sha) = \
+                    added[i], deleted[j]
+                del added_files[added_fname]
+                del deleted_files[deleted_fname]
+                yield deleted_fname, added_fname, deleted_sha, added_sha
+
+    for fname, sha in added_files.items():
+        yield None, fname, None, sha
+    for fname, sha in deleted_files.items():
+        yield fname, None, sha, None
+
+
+def _entry_files(mode, path, bin_sha):
+    """ Get (path, blob sha) of all files of a tree entry: either the file
+    itself or all files of the subtree """
+    if mode != "40000":
+        return [(path, binascii.hexlify(bin_sha))]
+    prefix = path + '/'
+    return [(prefix + fpath, sha)
+            for fpath, sha in _tree_files(Tree(bin_sha)).items()]
+
+
 class Tree(GitObject):
     """ A representation of git tree object, basically - a directory.
 
@@ -701,42 +3407,27 @@ class Tree(GitObject):
 
     def __iter__(self):
         """ Unpack binary tree structures, yielding 3-tuples of
-        (mode (ASCII decimal), filename, sha (40 bytes hex))
-
-        Format description:  https://stackoverflow.com/questions/14790681/
-            mode   (ASCII encoded decimal)
-            SPACE (\0x20)
-            filename
-            NULL (\x00)
-            20-byte binary hash
+        (mode (ASCII decimal), filename, sha (40 bytes hex)).
+        See `parse_tree` for the format description.
+
         >>> len(list(Tree("d4ddbae978c9ec2dc3b7b3497c2086ecf7be7d9d")))
         6
         >>> all(len(line) == 3
         ...     for line in Tree("954829887af5d9071aa92c427133ca2cdd0813cc"))
         True
         """
-        data = self.data
-
-        i = 0
-        while i < len(data):
-            # mode
-            start = i
-            while i < len(data) and data[i] != " ":
-                i += 1
-            mode = data[start:i]
-            i += 1
-            # file name
-            start = i
-            while i < len(data) and data[i] != "\x00":
-                i += 1
-            fname = data[start:i]
-            # sha
-            start = i + 1
-            i += 21
-            yield mode, fname, data[start:i].encode('hex')
+        for mode, fname, bin_sha in self.entries:
+            yield mode, fname, binascii.hexlify(bin_sha)
+
+    @cached_property
+    def entries(self):
+        """ Parsed tree content, a tuple of 3-tuples similar to iteration
+        but with 20 bytes binary SHAs: (mode, filename, bin_sha)
+        """
+        return parse_tree(self.data)
 
     def __len__(self):
-        return len(self.files)
+        return _tree_file_count(self, cache=False)
 
     def __contains__(self, item):
         if isinstance(item, File):
@@ -763,12 +3454,12 @@ class Tree(GitObject):
         >>> len(list(c.tree.traverse()))
         36
         """
-        for mode, fname, sha in self:
-            yield mode, fname, sha
+        for mode, fname, bin_sha in self.entries:
+            yield mode, fname, binascii.hexlify(bin_sha)
             # trees are always 40000:
             # https://stackoverflow.com/questions/1071241
             if mode == "40000":
-                for mode2, fname2, sha2 in Tree(sha).traverse():
+                for mode2, fname2, sha2 in Tree(bin_sha).traverse():
                     yield mode2, fname + '/' + fname2, sha2
 
     @property
@@ -802,8 +3493,8 @@ class Tree(GitObject):
         It includes recursive files (i.e. files in subdirectories).
         It does NOT include subdirectories themselves.
         """
-        return {fname: sha
-                for mode, fname, sha in self.traverse() if mode != "40000"}
+        # only subtrees are cached, so this dict is not shared
+        return _tree_files(self, cache=False)
 
     @property
     def blob_shas(self):
@@ -854,8 +3545,15 @@ class Commit(GitObject):
             authored_at:    timezone-aware datetime or None (if invalid)
             committer:      str, Name <email>
             committed_at:   timezone-aware datetime or None (if invalid)
+            authored_ts:    int, unix epoch or None (if invalid)
+            authored_tz:    int, timezone offset in minutes or None
+            committed_ts:   int, unix epoch or None (if invalid)
+            committed_tz:   int, timezone offset in minutes or None
             signature:      str or None, PGP signature
 
+        Dates are parsed only on access, so integer accessors (`*_ts`,
+        `*_tz`) are much cheaper than `authored_at` and `committed_at`.
+
         Commit: https://github.com/user2589/minicms/commit/e38126db
         >>> c = Commit('e38126dbca6572912013621d2aa9e6f7c50f36bc')
         >>> c.author.startswith('Marat')
@@ -870,9 +3568,36 @@ class Commit(GitObject):
         'ab124ab4baa42cd9f554b7bb038e19d4e3647957'
         >>> c.committed_at
         datetime.datetime(2012, 5, 19, 1, 14, 8, tzinfo=<Timezone: 11:00>)
+        >>> c.authored_ts, c.authored_tz
+        (1337350448, 660)
         """
+        if attr in ('authored_at', 'authored_ts', 'authored_tz',
+                    'committed_at', 'committed_ts', 'committed_tz'):
+            prefix = attr.split("_", 1)[0]
+            timestamp = getattr(self, '_%s_date' % prefix)
+            ts = tz = None
+            try:
+                ts, tz = parse_commit_ts(timestamp)
+            except (AttributeError, ValueError):
+                # missing or invalid timestamp
+                pass
+            if ts is not None and _is_future(ts):
+                ts = tz = None
+            setattr(self, prefix + '_ts', ts)
+            setattr(self, prefix + '_tz', tz)
+            if prefix + '_at' not in self.__dict__:  # not overridden
+                dt = None
+                if ts is not None:
+                    try:
+                        dt = datetime.fromtimestamp(ts, _timezone(tz))
+                    except ValueError:
+                        pass
+                setattr(self, prefix + '_at', dt)
+            return getattr(self, attr)
+
         attrs = ('tree', 'parent_shas', 'message', 'full_message', 'author',
-                 'committer', 'authored_at', 'committed_at', 'signature')
+                 'committer', '_authored_date', '_committed_date',
+                 'signature')
         if attr not in attrs:
             raise AttributeError
 
@@ -916,12 +3641,12 @@ class Commit(GitObject):
                 # timestamp is guaranteed to have one, so rsplit
                 chunks = value.rsplit(" ", 2)
                 self.author = chunks[0]
-                self.authored_at = parse_commit_date(" ".join(chunks[1:]))
+                self._authored_date = " ".join(chunks[1:])
             elif key == "committer":
                 # same logic as author
                 chunks = value.rsplit(" ", 2)
                 self.committer = chunks[0]
-                self.committed_at = parse_commit_date(" ".join(chunks[1:]))
+                self._committed_date = " ".join(chunks[1:])
             elif key == 'gpgsig':
                 signature = value
                 reading_signature = True
@@ -929,7 +3654,7 @@ class Commit(GitObject):
 
         return getattr(self, attr)
 
-    def __sub__(self, parent, threshold=0.5):
+    def __sub__(self, parent, threshold=0.5, rename_limit=RENAME_LIMIT):
         """ Compare two Commits.
 
         Args:
@@ -955,64 +3680,191 @@ class Commit(GitObject):
         Detecting the last one is computationally expensive. You can adjust this
         behaviour by passing the `threshold` parameter, which is 0.5 by default.
         It means that if roughly 50% of the file content is the same,
-        it is considered a match. `threshold=1` means that only exact
-        matches are considered, effectively disabling this comparison.
+        it is considered a match. `threshold=1` disables rename detection,
+        i.e. renamed files are reported as deleted and added.
         If threshold is set to 0, any pair of deleted and added file will be
         considered renamed and edited; this last case doesn't make much sense so
         don't set it too low.
+
+        Similar to git `diff.renameLimit`, inexact renames are not detected if
+        the number of added files times the number of deleted files exceeds
+        `rename_limit ** 2`.
         """
         if parent.sha not in self.parent_shas:
             warnings.warn("Comparing non-adjacent commits might be "
                           "computationally expensive. Proceed with caution.")
 
-        # filename: (blob sha before, blob sha after)
-        new_files = self.tree.files
-        new_paths = set(new_files.keys())
-        old_files = parent.tree.files
-        old_paths = set(old_files.keys())
-
-        # unchanged_paths
-        for fname in new_paths.intersection(old_paths):
-            if new_files[fname] != old_files[fname]:
-                # i.e. the Blob sha is the same
-                yield fname, fname, old_files[fname], new_files[fname]
-
-        added_paths = new_paths - old_paths
-        deleted_paths = old_paths - new_paths
-
-        if threshold >= 1:  # i.e. only exact matches are considered
-            for fname in added_paths:
-                yield None, fname, None, new_files[fname]
-            for fname in deleted_paths:
-                yield fname, None, old_files[fname], None
-            return
+        # only changed subtrees are compared, see tree_diff
+        added_files = {}
+        deleted_files = {}
+        for old_path, new_path, old_sha, new_sha in tree_diff(
+                parent.tree, self.tree):
+            if old_path is None:
+                added_files[new_path] = new_sha
+            elif new_path is None:
+                deleted_files[old_path] = old_sha
+            else:
+                yield old_path, new_path, old_sha, new_sha
 
-        # search for matches
-        sm = difflib.SequenceMatcher()
-        added_blobs = {f: Blob(new_files[f]) for f in added_paths}
-        deleted_blobs = {f: Blob(old_files[f]) for f in deleted_paths}
-        # for each added blob, try to find a match in deleted blobs
-        #   if there is a match, signal a rename and remove from deleted
-        #   if there is no match, signal a new file
-        # unused deleted blobs are indeed deleted
-        for added_fname, added_blob in added_blobs.items():
-            sm.set_seq1(added_blob)
-            matched = False
-            for deleted_fname, deleted_blob in deleted_blobs.items():
-                sm.set_seq2(deleted_blob)
-                # use quick checks first (lower bound by length diff)
-                if sm.real_quick_ratio() > threshold \
-                        and sm.quick_ratio() > threshold \
-                        and sm.ratio() > threshold:
-                    yield deleted_fname, added_fname, deleted_blob, added_blob
-                    del(deleted_blobs[deleted_fname])
-                    matched = True
-                    break
-            if not matched:  # this is a new file
-                yield None, added_fname, None, added_blob
+        for change in _detect_renames(
+                added_files, deleted_files, threshold, rename_limit):
+            yield change
+
+    @classmethod
+    def afetch(cls, sha):
+        """ Awaitable `Commit` with its content loaded, or None if it is
+        missing in the dataset. Concurrent requests are read in batches,
+        see `BatchExecutor` and `fetch_many`
+
+            >>> commit = await Commit.afetch(sha)  # doctest: +SKIP
+        """
+        return _awaitable(
+            _executor('ssd').submit(_fetch_commits, cls(sha).bin_sha))
+
+    @classmethod
+    def parse_many(cls, items, raw=False, keep_data=False,
+                   batch_size=BATCH_SIZE):
+        """ Parse many commits at once into columnar metadata
+
+        Unlike attribute access on `Commit` objects, it doesn't create any
+        per-commit objects, so it is suitable to turn millions of commits
+        into a dataframe. Input is consumed in chunks of `batch_size`;
+        if SHAs are passed, commit content is read in bulk chunk by chunk.
+
+        Args:
+            items (Iterable[str]): hex or binary commit SHAs or,
+                if `raw` is True, raw commit content
+            raw (bool): whether `items` are commit content rather than SHAs
+            keep_data (bool): whether to include raw commit content
+                in the result. It is needed to use `message_offset`
+            batch_size (int): number of commits to read and parse at once
+
+        Returns:
+            Dict[str, Union[np.ndarray, list]]: columns of the same length
+                as the input, except `parents`:
+
+                - found (bool array): False for commits missing in the
+                  dataset. Other columns are empty/zero for these commits
+                - sha, tree (S20 arrays): binary SHAs
+                - parent_ptr, parents: parent SHAs in CSR format, i.e.
+                  parents of the i-th commit are
+                  `parents[parent_ptr[i]:parent_ptr[i + 1]]`
+                - author, committer (lists of str): Name <email>
+                - authored_ts, committed_ts (int64 arrays): unix epochs,
+                  `NAT_TS` if invalid
+                - authored_tz, committed_tz (int16 arrays): timezone offsets
+                  in minutes
+                - message_offset (int64 array): offset of commit message
+                  in commit content
+                - data (list of str): commit content, if `keep_data`
+
+        >>> cols = Commit.parse_many(['tree ' + '0' * 40 + '\\n'
+        ...     'author A <a@a.com> 1337145807 +1100\\n'
+        ...     'committer B <b@b.com> 1337145808 -0130\\n\\nmessage'],
+        ...     raw=True)
+        >>> cols['author'], cols['committed_tz'], cols['parent_ptr']
+        (['A <a@a.com>'], array([-90], dtype=int16), array([0, 0]))
+        """
+        parts = [cls._parse_chunk(chunk, raw, keep_data)
+                 for chunk in _chunks(items, batch_size)] \
+            or [cls._parse_chunk([], raw, keep_data)]
+        if len(parts) == 1:
+            return parts[0]
+        result = {}
+        for column in parts[0]:
+            values = [part[column] for part in parts]
+            if column == 'parent_ptr':
+                # shift pointers of each chunk by parents of previous ones
+                shift = np.cumsum([0] + [v[-1] for v in values[:-1]])
+                values = [values[0]] + [
+                    v[1:] + offset for v, offset in zip(values[1:], shift[1:])]
+            if isinstance(values[0], list):
+                result[column] = [item for value in values for item in value]
+            else:
+                result[column] = np.concatenate(values)
+        return result
 
-        for deleted_fname, deleted_blob in deleted_blobs.items():
-            yield deleted_fname, None, deleted_blob, None
+    @classmethod
+    def _parse_chunk(cls, items, raw, keep_data):
+        """ Parse a chunk of commits, see `parse_many` """
+        if raw:
+            data = list(items)
+            bin_shas = [binascii.unhexlify(cls.string_sha(content))
+                        for content in data]
+        else:
+            bin_shas = [binascii.unhexlify(sha) if len(sha) == 40 else sha
+                        for sha in items]
+            data = cls._read_many(bin_shas)
+
+        size = len(data)
+        found = np.zeros(size, dtype=bool)
+        trees = []
+        parent_ptr = np.zeros(size + 1, dtype=np.int64)
+        parents = []
+        authors = [''] * size
+        committers = [''] * size
+        authored_ts = np.full(size, NAT_TS, dtype=np.int64)
+        committed_ts = np.full(size, NAT_TS, dtype=np.int64)
+        authored_tz = np.zeros(size, dtype=np.int16)
+        committed_tz = np.zeros(size, dtype=np.int16)
+        message_offset = np.zeros(size, dtype=np.int64)
+
+        for i, content in enumerate(data):
+            parent_ptr[i + 1] = parent_ptr[i]
+            if not content or not content.startswith('tree '):
+                trees.append('0' * 40)
+                continue
+            found[i] = True
+            trees.append(content[5:45])
+            header_end = content.find('\n\n')
+            if header_end < 0:
+                header_end = len(content)
+            message_offset[i] = min(header_end + 2, len(content))
+            # parents always come right after the tree
+            pos = 46
+            while content.startswith('parent ', pos):
+                parents.append(content[pos + 7:pos + 47])
+                pos += 48
+            parent_ptr[i + 1] += (pos - 46) // 48
+
+            for key, names, timestamps, timezones in (
+                    ('\nauthor ', authors, authored_ts, authored_tz),
+                    ('\ncommitter ', committers, committed_ts, committed_tz)):
+                start = content.find(key, 0, header_end)
+                if start < 0:
+                    continue
+                start += len(key)
+                end = content.find('\n', start)
+                if end < 0 or end > header_end:
+                    end = header_end
+                # name can contain spaces, timestamp is always the last
+                chunks = content[start:end].rsplit(' ', 2)
+                names[i] = chunks[0]
+                if len(chunks) == 3:
+                    try:  # invalid timezone invalidates the timestamp
+                        timezones[i] = _tz_minutes(chunks[2])
+                        timestamps[i] = int(chunks[1])
+                    # OverflowError: doesn't fit int64, i.e. invalid as well
+                    except (ValueError, OverflowError):  # leave NAT_TS
+                        timezones[i] = 0
+
+        result = {
+            'found': found,
+            'sha': sha_array(''.join(bin_shas)),
+            'tree': sha_array(binascii.unhexlify(''.join(trees))),
+            'parent_ptr': parent_ptr,
+            'parents': sha_array(binascii.unhexlify(''.join(parents))),
+            'author': authors,
+            'committer': committers,
+            'authored_ts': authored_ts,
+            'authored_tz': authored_tz,
+            'committed_ts': committed_ts,
+            'committed_tz': committed_tz,
+            'message_offset': message_offset,
+        }
+        if keep_data:
+            result['data'] = data
+        return result
 
     @property
     def parents(self):
@@ -1043,7 +3895,7 @@ class Commit(GitObject):
         >>> 'user2589_minicms' in c.project_names
         True
         """
-        data = decomp(self.read_tch('commit_projects'))
+        data = decomp(self.read_tch('commit_projects'), 'commit_projects')
         return tuple(project_name
                      for project_name in (data and data.split(";")) or []
                      if project_name and project_name != 'EMPTY')
@@ -1054,6 +3906,19 @@ class Commit(GitObject):
         """
         return (Project(uri) for uri in self.project_names)
 
+    @cached_property
+    def time_author(self):
+        # type: () -> Optional[Tuple[str, str]]
+        """ Commit timestamp and author from the compact `commit_time_author`
+        relation, without reading commit content. None if not available.
+
+        Commit: https://github.com/user2589/minicms/commit/f2a7fcdc
+        >>> Commit('f2a7fcdc51450ab03cb364415f14e634fa69b62c').time_author
+        ...     # doctest: +SKIP
+        ('1337350448', 'Marat <valiev.m@gmail.com>')
+        """
+        return _time_author(self.read_tch('commit_time_author'))
+
     @cached_property
     def child_shas(self):
         """ Children commit binary sha hashes.
@@ -1065,6 +3930,11 @@ class Commit(GitObject):
         """
         return slice20(self.read_tch('commit_children'))
 
+    @cached_property
+    def child_sha_set(self):
+        """ Same as `child_shas`, but as a compact `ShaSet` """
+        return ShaSet.from_raw(self.read_tch('commit_children'))
+
     @property
     def children(self):
         """ A generator of children `Commit` objects
@@ -1089,7 +3959,7 @@ class Commit(GitObject):
 
     @cached_property
     def changed_file_names(self):
-        data = decomp(self.read_tch('commit_files'))
+        data = decomp(self.read_tch('commit_files'), 'commit_files')
         return tuple((data and data.split(";")) or [])
 
     def files_changed(self):
@@ -1125,7 +3995,7 @@ class Commit(GitObject):
 
     @cached_property
     def files(self):
-        data = decomp(self.read_tch('commit_files'))
+        data = decomp(self.read_tch('commit_files'), 'commit_files')
         return tuple(file_name 
                      for file_name in (data and data.split(";")) or []
                      if file_name and file_name != 'EMPTY')
@@ -1138,6 +4008,523 @@ class Tag(GitObject):
     type = 'tag'
 
 
+def _time_author(raw_data):
+    # type: (Optional[str]) -> Optional[Tuple[str, str]]
+    """ Decode a `commit_time_author` value into (timestamp, author),
+    or None if it is missing or malformed """
+    try:
+        timestamp, author = decomp(
+            raw_data, 'commit_time_author').split(';', 1)
+    except (ValueError, TypeError, IndexError, AttributeError):
+        # corrupted LZF, or not a `time;author` record
+        return None
+    if not timestamp.lstrip('-').isdigit() or not author:
+        return None
+    return timestamp, author
+
+
+def _iter_commits(shas):
+    """ Lazy `Commit` objects, excluding GitHub merge button commits and
+    commits missing in the dataset.
+
+    Authors are checked in bulk using the `commit_time_author` relation,
+    so commit content is only read if the author is not available there
+    (or the record is malformed). Commits listed in `commit_time_author`
+    are not looked up in commit storage: the relation is derived from
+    commit content, so they are assumed to be present in the dataset.
+    """
+    for chunk in _chunks(shas, BATCH_SIZE):
+        bin_shas = [binascii.unhexlify(sha) if len(sha) == 40 else sha
+                    for sha in chunk]
+        commits = [None] * len(bin_shas)
+        authors = [None] * len(bin_shas)
+        unknown = []
+        for i, raw_data in enumerate(
+                read_tch_many('commit_time_author', bin_shas)):
+            time_author = _time_author(raw_data)
+            if time_author is None:
+                unknown.append(i)
+            else:
+                commits[i] = Commit(bin_shas[i])
+                commits[i]._time_author = time_author
+                authors[i] = time_author[1]
+        for i, c in zip(unknown, Commit.fetch_many(
+                bin_shas[i] for i in unknown)):
+            if c is not None:
+                commits[i], authors[i] = c, c.author
+
+        for c, author in zip(commits, authors):
+            if c is None:  # not in the dataset
+                continue
+            if author != MERGE_BUTTON:
+                yield c
+
+
+class ProjectGraph(object):
+    """ Commit DAG of a project, stored as integer-indexed arrays
+
+    Commits are numbered in the order of `Project.commit_shas`, excluding
+    commits missing in the dataset and GitHub merge button commits.
+    Use `Project.graph` rather than instantiating it directly.
+
+    Attributes:
+        sha (np.ndarray): S20 binary SHAs, one per commit
+        parent_ptr, parents (np.ndarray): parent indexes in CSR format,
+            i.e. parents of the i-th commit are
+            `parents[parent_ptr[i]:parent_ptr[i + 1]]`. Parents outside of
+            the project are represented by -1.
+        parent_sha (np.ndarray): S20 binary SHAs of parents, aligned with
+            `parents`, to handle parents outside of the project
+        first_parent (np.ndarray): index of the first parent,
+            -1 if there is no parent or it is outside of the project
+        authored_ts (np.ndarray): unix epochs of authored dates. Invalid,
+            future dates and dates earlier than the earliest root commit
+            are `NAT_TS` (see `Project.commits`)
+        heads (np.ndarray): indexes of commits which are nobody's parents
+        roots (np.ndarray): indexes of commits without parents
+
+    >>> g = ProjectGraph(['a' * 40, 'b' * 40], [[], ['a' * 40]], [1, 2])
+    >>> g.head, g.tail, list(g.first_parent_chain())
+    (1, 0, [1, 0])
+    """
+
+    def __init__(self, shas, parent_shas, authored_ts):
+        # type: (Sequence[str], Sequence[Sequence[str]], Sequence[int]) -> None
+        """
+        Args:
+            shas (Sequence[str]): hex or binary SHAs of the commits
+            parent_shas (Sequence[Sequence[str]]): hex or binary parent SHAs
+                of every commit
+            authored_ts (Sequence[int]): unix epochs, `NAT_TS` if invalid
+        """
+        def binary(sha):
+            return binascii.unhexlify(sha) if len(sha) == 40 else sha
+
+        bin_shas = [binary(sha) for sha in shas]
+        index = {sha: i for i, sha in enumerate(bin_shas)}
+        size = len(bin_shas)
+
+        self.sha = sha_array(''.join(bin_shas))
+        self.parent_ptr = np.zeros(size + 1, dtype=np.int64)
+        parent_bin_shas = []
+        for i, parents in enumerate(parent_shas):
+            parent_bin_shas.extend(binary(sha) for sha in parents)
+            self.parent_ptr[i + 1] = len(parent_bin_shas)
+        self.parent_sha = sha_array(''.join(parent_bin_shas))
+        self.parents = np.array(
+            [index.get(sha, -1) for sha in parent_bin_shas], dtype=np.int64)
+
+        has_parents = self.parent_ptr[1:] > self.parent_ptr[:-1]
+        self.first_parent = np.full(size, -1, dtype=np.int64)
+        self.first_parent[has_parents] = \
+            self.parents[self.parent_ptr[:-1][has_parents]]
+        self.roots = np.flatnonzero(~has_parents)
+        is_parent = np.zeros(size, dtype=bool)
+        is_parent[self.parents[self.parents >= 0]] = True
+        self.heads = np.flatnonzero(~is_parent)
+
+        ts = np.array(authored_ts, dtype=np.int64).reshape(size)
+        ts[ts > time.time()] = NAT_TS
+        # Sometimes (very rarely) commit dates are wrong.
+        # Anything before the earliest root commit is considered invalid
+        root_ts = ts[self.roots]
+        root_ts = root_ts[root_ts != NAT_TS]
+        min_ts = root_ts.min() if len(root_ts) else 0  # i.e. DAY_Z
+        ts[ts < min_ts] = NAT_TS
+        self.authored_ts = ts
+
+        self._index = index
+
+    @classmethod
+    def from_commits(cls, shas, batch_size=BATCH_SIZE, data=None):
+        # type: (Iterable[str], int, Optional[list]) -> ProjectGraph
+        """ Build a graph by reading commits in bulk (see `Commit.parse_many`)
+
+        Args:
+            shas (Iterable[str]): hex or binary commit SHAs
+            batch_size (int): number of commits to read at once
+            data (Optional[list]): if provided, content of commits in the
+                graph is appended to it, in the order of graph indexes
+        """
+        commit_shas, parent_shas, authored_ts = [], [], []
+        for chunk in _chunks(shas, batch_size):
+            cols = Commit.parse_many(
+                chunk, keep_data=data is not None, batch_size=batch_size)
+            sha_raw = cols['sha'].tobytes()
+            parents_raw = cols['parents'].tobytes()
+            ptr = cols['parent_ptr']
+            for i in np.flatnonzero(cols['found']):
+                if cols['author'][i] == MERGE_BUTTON:
+                    continue
+                commit_shas.append(sha_raw[i * 20:(i + 1) * 20])
+                parent_shas.append([parents_raw[j * 20:(j + 1) * 20]
+                                    for j in range(ptr[i], ptr[i + 1])])
+                authored_ts.append(cols['authored_ts'][i])
+                if data is not None:
+                    data.append(cols['data'][i])
+        return cls(commit_shas, parent_shas, authored_ts)
+
+    def __len__(self):
+        return len(self.sha)
+
+    def index(self, sha):
+        # type: (str) -> int
+        """ Get index of a commit by its hex or binary SHA
+
+        Raises:
+            KeyError: if the commit is not in the graph
+        """
+        if len(sha) == 40:
+            sha = binascii.unhexlify(sha)
+        return self._index[sha]
+
+    def bin_sha(self, idx):
+        # type: (int) -> str
+        return self.sha[idx:idx + 1].tobytes()
+
+    def hex_sha(self, idx):
+        # type: (int) -> str
+        return binascii.hexlify(self.bin_sha(idx))
+
+    def _sort_ts(self):
+        # invalid dates are considered DAY_Z
+        return np.where(self.authored_ts == NAT_TS, 0, self.authored_ts)
+
+    @property
+    def head(self):
+        # type: () -> Optional[int]
+        """ Index of the latest commit that is nobody's parent, or None """
+        if not len(self.heads):
+            return None
+        # it is possible that there is more than one head.
+        # E.g. it happens when HEAD is moved manually (git reset)
+        # and continued with a separate chain of commits.
+        # in this case, let's just use the latest one.
+        # Of equally dated heads, the last one is used
+        ts = self._sort_ts()[self.heads]
+        return int(self.heads[len(ts) - 1 - np.argmax(ts[::-1])])
+
+    @property
+    def latest(self):
+        # type: () -> Optional[int]
+        """ Index of the latest commit by authored date, or None """
+        if not len(self):
+            return None
+        return int(np.argmax(self._sort_ts()))
+
+    @property
+    def tail(self):
+        # type: () -> Optional[int]
+        """ Index of a root commit that is a first parent of some commit """
+        is_first_parent = np.zeros(len(self), dtype=bool)
+        is_first_parent[self.first_parent[self.first_parent >= 0]] = True
+        tails = self.roots[is_first_parent[self.roots]]
+        return int(tails[0]) if len(tails) else None
+
+    def first_parent_chain(self, start=None):
+        # type: (Optional[int]) -> Generator[int, None, None]
+        """ Indexes of commits following first parents, from `start`
+        (the latest commit by default) back to a root or a parent outside
+        of the project, which is not included.
+        """
+        idx = self.latest if start is None else start
+        while idx is not None and idx >= 0:
+            yield int(idx)
+            idx = self.first_parent[idx]
+
+    @cached_property
+    def topo_order(self):
+        # type: () -> np.ndarray
+        """ Commit indexes in topological order, parents before children """
+        size = len(self)
+        edges = self.parents >= 0
+        # child index for every parent edge
+        children = np.repeat(np.arange(size), np.diff(self.parent_ptr))
+        in_degree = np.bincount(children[edges], minlength=size)
+        order = np.argsort(self.parents[edges], kind='mergesort')
+        child_ptr = np.zeros(size + 1, dtype=np.int64)
+        child_ptr[1:] = np.cumsum(
+            np.bincount(self.parents[edges], minlength=size))
+        child_idx = children[edges][order]
+
+        result = np.empty(size, dtype=np.int64)
+        queue = list(np.flatnonzero(in_degree == 0))
+        n = 0
+        while queue:
+            idx = queue.pop()
+            result[n] = idx
+            n += 1
+            for child in child_idx[child_ptr[idx]:child_ptr[idx + 1]]:
+                in_degree[child] -= 1
+                if not in_degree[child]:
+                    queue.append(child)
+        # cycles are impossible in git, unless SHA1 collides
+        return result[:n]
+
+    @cached_property
+    def chrono_order(self):
+        # type: () -> np.ndarray
+        """ Commit indexes ordered by authored date, invalid dates first """
+        return np.argsort(self.authored_ts, kind='mergesort')
+
+    def date_range(self, start=None, end=None):
+        # type: (Union[datetime, int], Union[datetime, int]) -> np.ndarray
+        """ Indexes of commits authored in [start, end), in chronological
+        order. Commits with invalid dates are excluded.
+
+        Args:
+            start, end (Union[datetime, int, None]): timezone aware datetimes
+                or unix epochs. None means no limit.
+        """
+        def epoch(dt):
+            if isinstance(dt, datetime):
+                return (dt - DAY_Z).total_seconds()
+            return dt
+
+        ts = self.authored_ts[self.chrono_order]
+        lo = np.searchsorted(ts, NAT_TS, side='right')
+        if start is not None:
+            lo = max(lo, np.searchsorted(ts, epoch(start), side='left'))
+        hi = len(ts) if end is None else \
+            np.searchsorted(ts, epoch(end), side='left')
+        return self.chrono_order[lo:max(lo, hi)]
+
+
+class AncestryIndex(object):
+    """ Generation numbers and reachability queries for a closed set of
+    commits
+
+    Every commit gets a generation number, i.e. one plus the maximum
+    generation of its parents (root commits have generation 1).
+    Commit A can only be an ancestor of B if gen(A) < gen(B), which answers
+    some negative reachability queries in O(1) and prunes walks for the
+    rest, since branches are not followed below the generation of A.
+
+    The index is built from `commit_parent` (and, optionally,
+    `commit_children`) relations, so no commit content is read:
+
+        >>> sha = 'e38126dbca6572912013621d2aa9e6f7c50f36bc'
+        >>> idx = AncestryIndex.build([sha])  # doctest: +SKIP
+        >>> idx.is_ancestor(  # doctest: +SKIP
+        ...     '1e971a073f40d74a1e72e07c682e1cba0bae159b', sha)
+        True
+
+    It can also be built from known parents:
+
+        >>> idx = AncestryIndex(['a' * 40, 'b' * 40, 'c' * 40],
+        ...                     [[], ['a' * 40], ['a' * 40]])
+        >>> idx.is_ancestor('a' * 40, 'c' * 40)
+        True
+        >>> idx.is_ancestor('b' * 40, 'c' * 40)
+        False
+        >>> idx.merge_base('b' * 40, 'c' * 40) == ('a' * 40,)
+        True
+    """
+    STALE = 4
+
+    def __init__(self, shas, parent_shas):
+        # type: (Sequence[str], Sequence[Sequence[str]]) -> None
+        """
+        Args:
+            shas (Sequence[str]): hex or binary commit SHAs
+            parent_shas (Sequence[Sequence[str]]): parent SHAs of every
+                commit. Parents missing in `shas` are ignored, so the set
+                should be closed under parents (see `build`).
+        """
+        self.graph = ProjectGraph(shas, parent_shas, [NAT_TS] * len(shas))
+        size = len(self.graph)
+        ptr = self.graph.parent_ptr.tolist()
+        parents = self.graph.parents.tolist()
+        generation = [0] * size
+        for i in self.graph.topo_order.tolist():
+            gen = 0
+            for p in parents[ptr[i]:ptr[i + 1]]:
+                if p >= 0:
+                    gen = max(gen, generation[p])
+            generation[i] = gen + 1
+        self.generation = np.array(generation, dtype=np.int64)
+        self._parents = [tuple(p for p in parents[ptr[i]:ptr[i + 1]]
+                               if p >= 0) for i in range(size)]
+        self._generation = generation
+
+    @classmethod
+    def build(cls, seeds, descendants=False, max_size=None):
+        # type: (Iterable[str], bool, Optional[int]) -> AncestryIndex
+        """ Build an index for the seed commits and all their ancestors
+
+        Args:
+            seeds (Iterable[str]): hex or binary commit SHAs
+            descendants (bool): also include all descendants of the seed
+                commits (and their ancestors), e.g. to cover all forks
+            max_size (Optional[int]): maximum number of commits to index
+
+        Raises:
+            ValueError: if the closure is larger than `max_size`
+        """
+        def check_size(known):
+            if max_size is not None and len(known) > max_size:
+                raise ValueError("More than %d commits to index" % max_size)
+
+        def closure(dtype, frontier, known):
+            check_size(known)
+            while frontier:
+                values = read_tch_many(dtype, frontier)
+                if dtype == 'commit_parent':
+                    known.update((sha, slice20(raw))
+                                 for sha, raw in zip(frontier, values))
+                    check_size(known)
+                new = set()
+                for raw in values:
+                    size = len(raw or '') // 20 * 20
+                    new.update(raw[i:i + 20] for i in range(0, size, 20))
+                frontier = [sha for sha in new if sha not in known]
+                if dtype != 'commit_parent':
+                    known.update((sha, None) for sha in frontier)
+                    check_size(known)
+            return known
+
+        seeds = [binascii.unhexlify(sha) if len(sha) == 40 else sha
+                 for sha in seeds]
+        if descendants:
+            seeds = list(closure(
+                'commit_children', seeds, dict.fromkeys(seeds)))
+        parents = closure('commit_parent', seeds, {})
+        shas = list(parents.keys())
+        return cls(shas, [parents[sha] for sha in shas])
+
+    def __len__(self):
+        return len(self._generation)
+
+    def __contains__(self, sha):
+        try:
+            self.graph.index(sha)
+        except KeyError:
+            return False
+        return True
+
+    def _can_reach(self, idx, ancestor):
+        # type: (int, int) -> bool
+        """ Quick negative check, i.e. False means unreachable """
+        gen = self._generation
+        return idx == ancestor or gen[ancestor] < gen[idx]
+
+    def is_ancestor(self, ancestor, descendant):
+        # type: (str, str) -> bool
+        """ Check if a commit is an ancestor of (or the same as) another one,
+        same as `git merge-base --is-ancestor`
+
+        Raises:
+            KeyError: if any of the commits is not in the index
+        """
+        return self._is_ancestor(
+            self.graph.index(ancestor), self.graph.index(descendant))
+
+    def _is_ancestor(self, target, start):
+        # type: (int, int) -> bool
+        if not self._can_reach(start, target):
+            return False
+        # DFS, pruning branches that cannot possibly reach the target
+        stack = [start]
+        seen = {start}
+        while stack:
+            idx = stack.pop()
+            if idx == target:
+                return True
+            for p in self._parents[idx]:
+                if p not in seen and self._can_reach(p, target):
+                    seen.add(p)
+                    stack.append(p)
+        return False
+
+    def ancestors(self, sha, limit=None, min_generation=None):
+        # type: (str, Optional[int], Optional[int]) -> Iterator[str]
+        """ Ancestors of a commit (not including itself), from the latest
+        generation to the earliest
+
+        Args:
+            sha (str): hex or binary commit SHA
+            limit (Optional[int]): maximum number of ancestors to return
+            min_generation (Optional[int]): do not go beyond this generation
+        """
+        start = self.graph.index(sha)
+        heap = [(-self._generation[p], p) for p in self._parents[start]]
+        heapq.heapify(heap)
+        seen = set(p for _, p in heap)
+        count = 0
+        while heap and (limit is None or count < limit):
+            gen, idx = heapq.heappop(heap)
+            if min_generation is not None and -gen < min_generation:
+                break
+            yield self.graph.hex_sha(idx)
+            count += 1
+            for p in self._parents[idx]:
+                if p not in seen:
+                    seen.add(p)
+                    heapq.heappush(heap, (-self._generation[p], p))
+
+    def merge_base(self, sha1, sha2):
+        # type: (str, str) -> Tuple[str, ...]
+        """ Best common ancestors of two commits,
+        same as `git merge-base --all`
+
+        Commits are visited in the order of decreasing generation, and the
+        walk stops as soon as all remaining commits are known to be
+        ancestors of a common ancestor.
+
+        Returns:
+            Tuple[str, ...]: hex SHAs, empty if there is no common ancestor
+        """
+        one, two = self.graph.index(sha1), self.graph.index(sha2)
+        if self._is_ancestor(two, one):
+            return (self.graph.hex_sha(two),)
+        if self._is_ancestor(one, two):
+            return (self.graph.hex_sha(one),)
+
+        flags = {one: 1, two: 2}
+        heap = [(-self._generation[one], one), (-self._generation[two], two)]
+        candidates = []
+        while any(not flags[idx] & self.STALE for _, idx in heap):
+            _, idx = heapq.heappop(heap)
+            f = flags[idx]
+            if f & 3 == 3:
+                if not f & self.STALE:
+                    candidates.append(idx)
+                f |= self.STALE
+                flags[idx] = f
+            for p in self._parents[idx]:
+                if flags.get(p, 0) & f == f:
+                    continue
+                flags[p] = flags.get(p, 0) | f
+                heapq.heappush(heap, (-self._generation[p], p))
+
+        # remove candidates reachable from other candidates
+        return tuple(
+            self.graph.hex_sha(idx) for idx in candidates
+            if not any(other != idx and self._is_ancestor(idx, other)
+                       for other in candidates))
+
+    def save(self, path):
+        # type: (str) -> None
+        """ Save the index into a .npz file, see `load`.
+        Only the commit graph is saved, generation numbers are recomputed
+        on load, which takes no I/O """
+        np.savez(path, sha=self.graph.sha, parent_ptr=self.graph.parent_ptr,
+                 parent_sha=self.graph.parent_sha)
+
+    @classmethod
+    def load(cls, path):
+        # type: (str) -> AncestryIndex
+        """ Load an index saved by `save` """
+        with np.load(path) as data:
+            sha_raw = data['sha'].tobytes()
+            parent_raw = data['parent_sha'].tobytes()
+            ptr = data['parent_ptr']
+        return cls([sha_raw[i:i + 20] for i in range(0, len(sha_raw), 20)],
+                   [[parent_raw[j * 20:(j + 1) * 20]
+                     for j in range(ptr[i], ptr[i + 1])]
+                    for i in range(len(ptr) - 1)])
+
+
 class Project(_Base):
     """
     Projects are initialized with a URI:
@@ -1190,28 +4577,23 @@ class Project(_Base):
         >>> isinstance(commits[0], Commit)
         True
         """
-        for sha in self.commit_shas:
-            try:
-                c = Commit(sha)
-                author = c.author
-            except ObjectNotFound:
-                continue
-            if author != 'GitHub Merge Button <merge-button@github.com>':
-                yield c
+        return _iter_commits(self.commit_shas)
+
+    def acommits(self, data=True):
+        """ Commits of the project for `async for`, see `AsyncIterator`
+
+        Args:
+            data (bool): whether to read commit content in the background,
+                so accessing commit attributes doesn't block
+        """
+        return AsyncIterator(
+            self, prepare=_preload_commits if data else None)
 
     def __contains__(self, item):
         if isinstance(item, Commit):
-            key = item.key
-        elif isinstance(item, str):
-            if len(item) == 20:
-                key = item.encode('hex')
-            elif len(item) == 40:
-                key = item
-            else:
-                return False
-        else:
-            return False
-        return key in self.commit_shas
+            item = item.bin_sha
+        # ShaSet takes care of hex/binary SHAs
+        return item in self.commit_sha_set
 
     @cached_property
     def commit_shas(self):
@@ -1223,7 +4605,30 @@ class Project(_Base):
          '7572fc070c44f85e2a540f9a5a05a95d1dd2662d')
         """
         tch_path = self.resolve_path('project_commits')
-        return slice20(read_tch(tch_path, self.key, silent=True))
+        return slice20(read_tch(
+            tch_path, self.key, silent=True, dtype='project_commits'))
+
+    @cached_property
+    def commit_sha_set(self):
+        """ Same as `commit_shas`, but as a compact `ShaSet`.
+        Used for membership checks, e.g. `commit in project` """
+        tch_path = self.resolve_path('project_commits')
+        return ShaSet.from_raw(read_tch(
+            tch_path, self.key, silent=True, dtype='project_commits'))
+
+    @cached_property
+    def graph(self):
+        # type: () -> ProjectGraph
+        """ Commit DAG of the project, built once and reused by `commits`,
+        `head`, `tail` and `commits_fp`
+
+        >>> g = Project('user2589_minicms').graph
+        >>> g.hex_sha(g.head)
+        'f2a7fcdc51450ab03cb364415f14e634fa69b62c'
+        >>> [g.hex_sha(i) for i in g.topo_order[:1]]
+        ['1e971a073f40d74a1e72e07c682e1cba0bae159b']
+        """
+        return ProjectGraph.from_commits(self.commit_shas)
 
     @property
     def commits(self):
@@ -1236,18 +4641,28 @@ class Project(_Base):
         (<Commit: 2dbcd43f077f2b5511cc107d63a0b9539a6aa2a7>,
          <Commit: 7572fc070c44f85e2a540f9a5a05a95d1dd2662d>)
         """
-        commits = tuple(c for c in self)
-        tails = tuple(c for c in commits
-                      if not c.parent_shas and c.authored_at is not None)
-        if tails:
-            min_date = min(c.authored_at for c in tails)
-        else:  # i.e. if all tails have invalid date
-            min_date = DAY_Z
-
-        for c in commits:
-            if c.authored_at and c.authored_at < min_date:
-                c.authored_at = None
-            yield c
+        data = None
+        if not hasattr(self, '_graph'):
+            # build the graph from the same read as commit objects
+            data = []
+            self._graph = ProjectGraph.from_commits(
+                self.commit_shas, data=data)
+        graph = self.graph
+        for start in range(0, len(graph), BATCH_SIZE):
+            chunk = graph.sha[start:start + BATCH_SIZE].tobytes()
+            bin_shas = [chunk[i:i + 20] for i in range(0, len(chunk), 20)]
+            if data is None:
+                commits = Commit.fetch_many(bin_shas)
+            else:
+                commits = [Commit(bin_sha) for bin_sha in bin_shas]
+                for c, content in zip(
+                        commits, data[start:start + BATCH_SIZE]):
+                    c._data = content
+            for idx, c in enumerate(commits, start):
+                # see ProjectGraph.authored_ts
+                if graph.authored_ts[idx] == NAT_TS:
+                    c.authored_at = None
+                yield c
 
     @cached_property
     def head(self):
@@ -1259,18 +4674,10 @@ class Project(_Base):
         <Commit: a47afa002ccfd3e23920f323b172f78c5c970250>
         """
         # Sometimes (very rarely) commit dates are wrong, so the latest commit
-        # is not actually the head. The magic below is to account for this
-        commits = {c.sha: c for c in self.commits}
-        parents = set().union(*(c.parent_shas for c in commits.values()))
-        heads = set(commits.keys()) - parents
-
-        # it is possible that there is more than one head.
-        # E.g. it happens when HEAD is moved manually (git reset)
-        # and continued with a separate chain of commits.
-        # in this case, let's just use the latest one
-        # actually, storing refs would make it much simpler
-        return sorted((commits[sha] for sha in heads),
-                      key=lambda c: c.authored_at or DAY_Z)[-1]
+        # is not actually the head. So, only commits that are nobody's
+        # parents are considered, see ProjectGraph.head
+        idx = self.graph.head
+        return None if idx is None else Commit(self.graph.bin_sha(idx))
 
     @cached_property
     def tail(self):
@@ -1279,11 +4686,8 @@ class Project(_Base):
         >>> Project('user2589_minicms').tail
         '1e971a073f40d74a1e72e07c682e1cba0bae159b'
         """
-        commits = {c.sha: c for c in self.commits}
-        pts = set(c.parent_shas[0] for c in commits.values() if c.parent_shas)
-        for sha, c in commits.items():
-            if sha in pts and not c.parent_shas:
-                return sha
+        idx = self.graph.tail
+        return None if idx is None else self.graph.hex_sha(idx)
 
     @property
     def commits_fp(self):
@@ -1313,11 +4717,18 @@ class Project(_Base):
         # Execution time:
         #   simplified version (argmax): ~153 seconds
         #   self.head(): ~190 seconds
+        graph = self.graph
+        idx = None
+        for idx in graph.first_parent_chain():
+            yield Commit(graph.bin_sha(idx))
+        if idx is None:
+            return
 
-        # at this point we know all commits are in the dataset
-        # (validated in __iter___)
-        commits = {c.sha: c for c in self.commits}
-        commit = max(commits.values(), key=lambda c: c.authored_at or DAY_Z)
+        # first parent outside of the project, if any
+        ptr = graph.parent_ptr[idx]
+        if ptr == graph.parent_ptr[idx + 1]:
+            return
+        commit = Commit(graph.parent_sha[ptr:ptr + 1].tobytes())
         while commit:
             try:  # here there is no guarantee commit is in the dataset
                 first_parent = commit.parent_shas and commit.parent_shas[0]
@@ -1329,7 +4740,7 @@ class Project(_Base):
             if not first_parent:
                 break
 
-            commit = commits.get(first_parent, Commit(first_parent))
+            commit = Commit(first_parent)
 
     @cached_property
     def url(self):
@@ -1349,7 +4760,7 @@ class Project(_Base):
 
     @cached_property
     def author_names(self):
-        data = decomp(self.read_tch('project_authors'))
+        data = decomp(self.read_tch('project_authors'), 'project_authors')
         return tuple(author_name 
                      for author_name in (data and data.split(";")) or []
                      if author_name and author_name != 'EMPTY')
@@ -1371,7 +4782,7 @@ class File(_Base):
 
     @cached_property
     def authors(self):
-        data = decomp(self.read_tch('file_authors'))
+        data = decomp(self.read_tch('file_authors'), 'file_authors')
         return tuple(author for author in (data and data.split(";")))
 
     @cached_property
@@ -1395,7 +4806,15 @@ class File(_Base):
         # if not file_path.endswith("\n"):
         #     file_path += "\n"
         tch_path = resolve_path('file_commits', file_path, self.use_fnv_keys)
-        return slice20(read_tch(tch_path, file_path, silent=True))
+        return slice20(read_tch(
+            tch_path, file_path, silent=True, dtype='file_commits'))
+
+    @cached_property
+    def commit_sha_set(self):
+        """ Same as `commit_shas`, but as a compact `ShaSet` """
+        tch_path = resolve_path('file_commits', self.key, self.use_fnv_keys)
+        return ShaSet.from_raw(read_tch(
+            tch_path, self.key, silent=True, dtype='file_commits'))
 
     @property
     def commits(self):
@@ -1410,14 +4829,7 @@ class File(_Base):
         >>> isinstance(cs[0], Commit)
         True
         """
-        for sha in self.commit_shas:
-            c = Commit(sha)
-            try:
-                author = c.author
-            except ObjectNotFound:
-                continue
-            if author != 'GitHub Merge Button <merge-button@github.com>':
-                yield c
+        return _iter_commits(self.commit_shas)
 
     def __str__(self):
         return super(File, self).__str__().rstrip("\n\r")
@@ -1456,6 +4868,13 @@ class Author(_Base):
         """
         return slice20(self.read_tch('author_commits', silent=True))
 
+    @cached_property
+    def commit_sha_set(self):
+        """ Same as `commit_shas`, but as a compact `ShaSet`.
+        Prolific authors have millions of commits, so prefer it to check
+        membership """
+        return ShaSet.from_raw(self.read_tch('author_commits', silent=True))
+
     @property
     def commits(self):
         """ A generator of all Commit objects authored by the Author
@@ -1470,7 +4889,7 @@ class Author(_Base):
 
     @cached_property
     def files(self):
-        data = decomp(self.read_tch('author_files'))
+        data = decomp(self.read_tch('author_files'), 'author_files')
         return tuple(file for file in (data and data.split(";")))
     
     @cached_property
@@ -1478,13 +4897,13 @@ class Author(_Base):
         """ URIs of projects where author has committed to 
 A generator of all Commit objects authored by the Author
         """
-        data = decomp(self.read_tch('author_projects'))
+        data = decomp(self.read_tch('author_projects'), 'author_projects')
         return tuple(project_name
           for project_name in (data and data.split(";")) or [] if project_name and project_name != 'EMPTY')
     
     @cached_property
     def torvald(self):
-      data = decomp(self.read_tch('author_trpath'))
+      data = decomp(self.read_tch('author_trpath'), 'author_trpath')
       return tuple(path for path in (data and data.split(";")))
 
 
@@ -1496,6 +4915,8 @@ class Clickhouse_DB(object):
         self.tb_name = tb_name
         self.db_host = db_host
         self.client_settings = {'strings_as_bytes':True, 'max_block_size':100000}
+        # optional backend, so it is only imported when used
+        import clickhouse_driver as clickhouse
         self.client = clickhouse.Client(host=self.db_host, settings=self.client_settings)
 
     def query(self, query_str):
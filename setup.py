@@ -26,7 +26,8 @@ setup(
     py_modules=['oscar'],
     author_email='marat@cmu.edu',
     url='https://github.com/ssc-oscar/oscar.py',
-    install_requires=['python-lzf', 'tokyocabinet', 'pygit2', 'fnvhash', 'clickhouse-driver'],
+    install_requires=['python-lzf', 'tokyocabinet', 'fnvhash', 'clickhouse-driver',
+                      'numpy'],
     test_suite='test.TestStatus',
     **kwargs
 )
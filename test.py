@@ -323,6 +323,14 @@ class TestRelations(unittest.TestCase):
             diff, "Prj2Cmt doesn't list commits %s in project %s but they're "
                   "on github" % (",".join(diff), project))
 
+    def test_project_iter(self):
+        """ Commits listed in c2taFull are yielded without reading their
+        content, so they should match commits found in commit storage """
+        project = Project('user2589_minicms')
+        self.assertEqual({c.sha for c in project},
+                         {c.sha for c in project.commits},
+                         "c2taFull lists commits missing in commit storage")
+
 
 if __name__ == "__main__":
     import oscar